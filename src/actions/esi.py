@@ -1,36 +1,68 @@
 import aiohttp
 import json
 import logging
-from collections import defaultdict
+import os
 from datetime import datetime, timezone, timedelta
 from discord import Interaction
 from json import JSONDecodeError
 from preston import Preston
 
-from messaging import send_background_message
-from models import Character
+from actions.structure import remove_structure_subscriptions
+from authentication import character_from_token
+from database import run_db
+from esi_client import esi_call
+from messaging import outbox_entry, write_outbox
+from models import Character, SentWarning, as_utc, db
+from scheduler import structure_schedule
 
 # Configure the logger
 logger = logging.getLogger('discord.timer.warnings')
 
-sent_warnings = {}
+# ESI responses which mean that a character lost access, its polls back off after repeated ones
+backoff_statuses = [400, 401, 403]
+
+# Characters which failed twice in a row are polled again after this many seconds, doubling up to the maximum
+CHARACTER_BACKOFF = int(os.getenv("CHARACTER_BACKOFF", "600"))
+CHARACTER_MAX_BACKOFF = int(os.getenv("CHARACTER_MAX_BACKOFF", str(24 * 60 * 60)))
+
+# Characters which can be reached neither through ESI nor through discord for this many seconds are deleted
+CHARACTER_DISCONNECTED_TIME = int(os.getenv("CHARACTER_DISCONNECTED_TIME", str(24 * 60 * 60)))
+
+# Notification and structure polls back off on their own, e.g. characters without the Station Manager role
+# keep polling notifications fine while their structure polls fail
+NOTIFICATIONS = "notifications"
+STRUCTURES = "structures"
+backoff_fields = {
+    NOTIFICATIONS: (Character.failure_count, Character.backoff_until),
+    STRUCTURES: (Character.structure_failure_count, Character.structure_backoff_until),
+}
+
+
+def store_background_warning(user, warning_text: str, log_text: str) -> bool:
+    """Write a warning to the outbox unless the same warning was written within the last day.
+    Returns true if it was written."""
+    now = datetime.now(tz=timezone.utc)
+    with db.atomic():
+        sent_warning = SentWarning.get_or_none(SentWarning.log_text == log_text)
+        if sent_warning is not None and as_utc(sent_warning.next_at) > now:
+            return False
+
+        write_outbox([outbox_entry(user, warning_text, log_text)])
+        SentWarning.insert(log_text=log_text, next_at=now + timedelta(days=1)).on_conflict(
+            conflict_target=[SentWarning.log_text],
+            preserve=[SentWarning.next_at],
+        ).execute()
+        return True
 
 
-async def send_background_warning(bot, user, warning: tuple[str, str], quiet: bool = False):
-    """Send a warning message to a user from a background process, making sure
+async def send_background_warning(user, warning: tuple[str, str]):
+    """Queue a warning message to a user from a background process, making sure
     not to repeat the warning to many times and spamming the user"""
 
     warning_text, log_text = warning
 
-    if log_text in sent_warnings and sent_warnings[log_text] > datetime.now(tz=timezone.utc).timestamp():
-        logger.debug(f"Received warning {log_text}, waiting for next window at {sent_warnings[log_text]}")
-        return True
-    else:
-        if await send_background_message(bot, user, warning_text, quiet=quiet):
-            sent_warnings[log_text] = (datetime.now(tz=timezone.utc) + timedelta(days=1)).timestamp()
-            return True
-        else:
-            return False
+    if not await run_db(store_background_warning, user, warning_text, log_text):
+        logger.debug(f"Received warning {log_text}, waiting for next window.")
 
 
 async def send_foreground_warning(interaction: Interaction, warning: tuple[str, str]):
@@ -42,10 +74,12 @@ async def send_foreground_warning(interaction: Interaction, warning: tuple[str,
 async def esi_permission_warning(character: Character, preston: Preston):
     """Send a warning to users to fix ESI permissions."""
     try:
-        character_name = await preston.get_op(
+        character_name = (await esi_call(
+            preston.get_op,
             'get_characters_character_id',
-            character_id=character.character_id
-        ).get("name")
+            character_id=character.character_id,
+            critical=False,
+        )).get("name")
 
         warning_text = (
             "### WARNING\n"
@@ -53,7 +87,7 @@ async def esi_permission_warning(character: Character, preston: Preston):
             "- If you to not intend to use this character anymore, remove him with `/revoke {character_name}`.\n"
             "- Otherwise re-authenticate with `/auth`."
         )
-    except (ValueError, KeyError, JSONDecodeError):
+    except (ValueError, KeyError, JSONDecodeError, aiohttp.ClientError):
         warning_text = (
             "### WARNING\n"
             f"<@{character.user.user_id}>, your characters do not have permissions to fetch data from ESI.\n"
@@ -69,7 +103,7 @@ async def esi_permission_warning(character: Character, preston: Preston):
 async def structure_permission_warning(character: Character, authed_preston: Preston):
     """A warning to users to fix in corporation permissions."""
 
-    character_name = (await authed_preston.whoami()).get("character_name")
+    character_name = (await character_from_token(authed_preston)).get("character_name")
 
     warning_text = (
         "### WARNING\n"
@@ -86,7 +120,7 @@ async def structure_permission_warning(character: Character, authed_preston: Pre
 
 async def structure_corp_warning(character: Character, authed_preston: Preston):
     """A warning to users who have changed corp."""
-    character_name = (await authed_preston.whoami()).get("character_name")
+    character_name = (await character_from_token(authed_preston)).get("character_name")
 
     warning_text = (
         "### WARNING\n"
@@ -103,7 +137,7 @@ async def structure_corp_warning(character: Character, authed_preston: Preston):
 
 
 async def structure_other_warning(character: Character, authed_preston: Preston, error_value: str):
-    character_name = (await authed_preston.whoami()).get("character_name")
+    character_name = (await character_from_token(authed_preston)).get("character_name")
 
     warning_text = (
         "### WARNING\n"
@@ -156,81 +190,172 @@ def get_error_text(exception: aiohttp.ClientResponseError):
         return ""
 
 
-character_double_disconnected_count = defaultdict(int)
-
-
-async def handle_auth_error(character, bot, user, preston, exception: aiohttp.ClientResponseError):
+def backoff_end(character, kind: str) -> datetime | None:
+    """Returns the time until which one kind of poll of a character is backing off, if it is."""
+    _, backoff_field = backoff_fields[kind]
+    backoff_until = getattr(character, backoff_field.name)
+    if backoff_until is None:
+        return None
+    return as_utc(backoff_until)
+
+
+def is_backed_off(character, kind: str) -> bool:
+    """Returns true if one kind of poll of a character failed repeatedly and should not run yet."""
+    backoff_until = backoff_end(character, kind)
+    return backoff_until is not None and backoff_until > datetime.now(tz=timezone.utc)
+
+
+async def record_character_failure(character, exception: aiohttp.ClientResponseError, kind: str):
+    """Count a failed ESI call of a character and back off this kind of poll exponentially after repeated failures."""
+    if getattr(exception, "status", 0) not in backoff_statuses:
+        return
+
+    count_field, backoff_field = backoff_fields[kind]
+    failure_count = getattr(character, count_field.name) + 1
+    backoff_until = getattr(character, backoff_field.name)
+    if failure_count >= 2:
+        delay = min(CHARACTER_MAX_BACKOFF, CHARACTER_BACKOFF * 2 ** (failure_count - 2))
+        backoff_until = datetime.now(tz=timezone.utc) + timedelta(seconds=delay)
+        logger.info(f"{character} failed {failure_count} {kind} polls in a row, backing off for {delay} seconds.")
+
+    setattr(character, count_field.name, failure_count)
+    setattr(character, backoff_field.name, backoff_until)
+    await run_db(Character.update({count_field: failure_count, backoff_field: backoff_until}).where(
+        Character.character_id == character.character_id
+    ).execute)
+
+
+async def record_character_success(character, kind: str):
+    """Reset the failure state of one kind of poll of a character once it could be used again."""
+    count_field, backoff_field = backoff_fields[kind]
+    failure_count = getattr(character, count_field.name)
+    if failure_count == 0 and getattr(character, backoff_field.name) is None:
+        return
+
+    logger.info(f"{character} recovered from {failure_count} failed {kind} polls.")
+    setattr(character, count_field.name, 0)
+    setattr(character, backoff_field.name, None)
+    # The character could authenticate again, so it is no longer disconnected either
+    character.disconnected_count = 0
+    character.disconnected_since = None
+    await run_db(Character.update({
+        count_field: 0, backoff_field: None, Character.disconnected_count: 0, Character.disconnected_since: None
+    }).where(Character.character_id == character.character_id).execute)
+
+
+async def record_structure_access(character, access: bool | None):
+    """Remember whether a character can see the structures of its corporation, None if that is not known.
+    Only users with a character that can see them receive structure messages of a corporation."""
+    if character.structure_access == access:
+        return
+
+    logger.info(f"{character} structure access changed from {character.structure_access} to {access}.")
+    lost = character.structure_access is not False and access is False
+    character.structure_access = access
+    await run_db(Character.update(structure_access=access).where(
+        Character.character_id == character.character_id
+    ).execute)
+    if lost:
+        await run_db(remove_structure_subscriptions, character.corporation_id, character.user_id)
+
+
+async def handle_auth_error(character, user, preston, exception: aiohttp.ClientResponseError):
     if getattr(exception, "status", 0) in [400, 401]:
-        success = await send_background_warning(
-            bot, user,
+        await send_background_warning(
+            user,
             await esi_permission_warning(character, preston)
         )
 
-        if not success:
-            character_double_disconnected_count[character.character_id] += 1
+        # The outbox counts the deliveries to the user which failed in a row
+        now = datetime.now(tz=timezone.utc)
+        if user.disconnected_count == 0:
+            character.disconnected_count = 0
+            character.disconnected_since = None
         else:
-            character_double_disconnected_count[character.character_id] = 0
-
-        if character_double_disconnected_count[character.character_id] > 100:
+            character.disconnected_count += 1
+            character.disconnected_since = character.disconnected_since or now
+        await run_db(Character.update(
+            disconnected_count=character.disconnected_count, disconnected_since=character.disconnected_since
+        ).where(Character.character_id == character.character_id).execute)
+
+        # Polls of the character back off, so the time it is unreachable counts instead of its failed polls
+        if (character.disconnected_since is not None
+                and now - as_utc(character.disconnected_since) > timedelta(seconds=CHARACTER_DISCONNECTED_TIME)):
             logger.error(
                 f"{character} can not be reached on either side (ESI & Discord) and will be deleted."
             )
-            character = Character.get_or_none(character.character_id)
-            character.delete_instance()
+            await run_db(Character.delete().where(Character.character_id == character.character_id).execute)
 
     else:
-        character_double_disconnected_count[character.character_id] = 0
+        if character.disconnected_count or character.disconnected_since is not None:
+            character.disconnected_count = 0
+            character.disconnected_since = None
+            await run_db(Character.update(disconnected_count=0, disconnected_since=None).where(
+                Character.character_id == character.character_id
+            ).execute)
         logger.warning(
             f"Auth for {character} encountered ClientResponseError: status={getattr(exception, 'status', None)}, message={get_error_text(exception)}"
         )
 
 
 async def handle_structure_error(character, authed_preston, exception: aiohttp.ClientResponseError,
-                                 bot=None, user=None, interaction=None):
+                                 user=None, interaction=None):
     error_text = get_error_text(exception)
     if error_text == "Character does not have required role(s)":
+        await record_structure_access(character, False)
         warning_text = await structure_permission_warning(character, authed_preston)
         if interaction is not None:
             await send_foreground_warning(interaction, warning_text)
-        if bot is not None and user is not None:
-            await send_background_warning(bot, user, warning_text)
+        if user is not None:
+            await send_background_warning(user, warning_text)
 
     elif error_text in ["Character is not in the corporation", "Forbidden"]:
         try:
             # Try fast affiliation API
-            new_corporation = (await authed_preston.post_op(
+            new_corporation = (await esi_call(
+                authed_preston.post_op,
                 'post_characters_affiliation',
                 path_data={},
                 post_data=[character.character_id]
             ))[0].get("corporation_id")
         except Exception as e:
             # Fall back to slow character API
-            new_corporation = (await authed_preston.get_op(
+            new_corporation = (await esi_call(
+                authed_preston.get_op,
                 'get_characters_character_id',
                 character_id=character.character_id
             )).get("corporation_id")
 
-        if character.corporation_id == new_corporation:
+        if str(character.corporation_id) == str(new_corporation):
+            await record_structure_access(character, False)
             warning_text = await structure_corp_warning(character, authed_preston)
             if interaction is not None:
                 await send_foreground_warning(interaction, warning_text)
-            if bot is not None and user is not None:
-                await send_background_warning(bot, user, warning_text)
+            if user is not None:
+                await send_background_warning(user, warning_text)
         else:
             old_corporation = character.corporation_id
-            character.corporation_id = new_corporation
-            character.save()
+            had_access = character.structure_access
+            character.corporation_id = str(new_corporation)
+            character.structure_access = None
+            character.updated_at = datetime.now(tz=timezone.utc)
+            await run_db(character.save)
+            if had_access is not False:
+                await run_db(remove_structure_subscriptions, old_corporation, character.user_id)
+            structure_schedule.add(str(new_corporation), immediately=True)
             if interaction is not None:
                 await interaction.followup.send(
                     f"Your character’s corporation ID `{old_corporation}` changed to `{new_corporation}`, which is now updated. Please retry the last command."
                 )
 
     else:
+        if getattr(exception, "status", 0) == 403:
+            await record_structure_access(character, False)
         warning_text = await structure_other_warning(character, authed_preston, error_text)
         if interaction is not None:
             await send_foreground_warning(interaction, warning_text)
-        if bot is not None and user is not None:
-            await send_background_warning(bot, user, warning_text)
+        if user is not None:
+            await send_background_warning(user, warning_text)
 
     logger.warning(
         f"Structure fetch for {character} encountered ClientResponseError: status={getattr(exception, 'status', None)}, message={error_text}"
@@ -1,16 +1,33 @@
-import aiohttp
 import dateutil.parser
 import logging
 from datetime import datetime, timezone, timedelta
+from peewee import chunked
 from preston import Preston
 
-from messaging import send_background_message
-from models import Notification
+from database import run_db
+from messaging import Priority, outbox_entry, write_outbox
+from models import Notification, as_utc, db
+from names import CHARACTER, PLANET, STRUCTURE, resolve_names
 
 # Configure the logger
 logger = logging.getLogger('discord.timer.notification')
 logger.setLevel(logging.INFO)
 
+# Notifications about ongoing fights, which are delivered before anything else
+combat_notification_types = [
+    "StructureUnderAttack",
+    "StructureLostShields",
+    "StructureLostArmor",
+    "OrbitalAttacked",
+    "OrbitalReinforced",
+]
+
+# Notifications which move a corporation into the hot polling tier
+hot_notification_types = [
+    "StructureUnderAttack",
+    "StructureLostShields",
+]
+
 
 def get_structure_id(notification: dict) -> int | None:
     """returns a structure id from the notification or none if no structure_id can be found"""
@@ -30,19 +47,32 @@ def get_attacker_character_id(notification: dict) -> int | None:
     return None
 
 
-async def make_attribution(notification: dict, preston: Preston) -> str:
+def get_planet_id(notification: dict) -> str | None:
+    """returns a planet id from the notification or None if no planet_id can be found"""
+    planet_id = None
+    for line in notification.get("text").split("\n"):
+        if "planetID:" in line:
+            planet_id = line.split(" ")[1]
+    return planet_id
+
+
+def name_keys(notification: dict) -> list[tuple]:
+    """returns the (category, id) pairs of all names needed to describe a notification"""
+    keys = [(CHARACTER, get_attacker_character_id(notification))]
+    if is_structure_notification(notification):
+        keys.append((STRUCTURE, get_structure_id(notification)))
+    if is_poco_notification(notification):
+        keys.append((PLANET, get_planet_id(notification)))
+    return keys
+
+
+def make_attribution(notification: dict, names: dict) -> str:
     character_id = get_attacker_character_id(notification)
-    if character_id is None:
+    if character_id is None or (CHARACTER, str(character_id)) not in names:
         return ""
 
-    try:
-        character_name = (await preston.get_op(
-            'get_characters_character_id',
-            character_id=str(character_id)
-        )).get("name", "Unknown")
-        return f" by [{character_name}](https://zkillboard.com/character/{character_id}/)"
-    except aiohttp.ClientResponseError:
-        return ""
+    character_name = names[(CHARACTER, str(character_id))]
+    return f" by [{character_name}](https://zkillboard.com/character/{character_id}/)"
 
 
 def get_reinforce_exit_time(notification: dict) -> datetime | None:
@@ -63,16 +93,10 @@ def poco_timer_text(notification: dict) -> str:
     return f"**Timer:** <t:{int(state_expires.timestamp())}> (<t:{int(state_expires.timestamp())}:R>) ({state_expires} ET)\n"
 
 
-async def structure_notification_text(notification: dict, authed_preston: Preston) -> str:
+def structure_notification_text(notification: dict, names: dict) -> str:
     """Returns a human-readable message of a structure notification"""
-    # noinspection PyBroadException
-    try:
-        structure_name = (await authed_preston.get_op(
-            "get_universe_structures_structure_id",
-            structure_id=str(get_structure_id(notification)),
-        )).get("name")
-    except Exception:
-        structure_name = f"Structure {get_structure_id(notification)}"
+    structure_id = get_structure_id(notification)
+    structure_name = names.get((STRUCTURE, str(structure_id)), f"Structure {structure_id}")
 
     match notification.get('type'):
         case "StructureLostArmor":
@@ -82,7 +106,7 @@ async def structure_notification_text(notification: dict, authed_preston: Presto
         case "StructureUnanchoring":
             return f"@everyone Structure {structure_name} is now unanchoring!\n"
         case "StructureUnderAttack":
-            return f"@everyone Structure {structure_name} is under attack{await make_attribution(notification, authed_preston)}!\n"
+            return f"@everyone Structure {structure_name} is under attack{make_attribution(notification, names)}!\n"
         case "StructureWentHighPower":
             return f"@everyone Structure {structure_name} is now high power!\n"
         case "StructureWentLowPower":
@@ -93,30 +117,38 @@ async def structure_notification_text(notification: dict, authed_preston: Presto
             return ""
 
 
-async def get_poco_name(notification: dict, preston: Preston) -> str:
-    """returns a structure id from the notification or none if no structure_id can be found"""
-    planet_id = None
-    for line in notification.get("text").split("\n"):
-        if "planetID:" in line:
-            planet_id = line.split(" ")[1]
-
-    if planet_id is not None:
-        return (await preston.get_op("get_universe_planets_planet_id", planet_id=planet_id)).get("name")
-    return "Unknown Poco"
+def get_poco_name(notification: dict, names: dict) -> str:
+    """returns the name of the planet of a poco notification"""
+    return names.get((PLANET, get_planet_id(notification)), "Unknown Poco")
 
 
-async def poco_notification_text(notification: dict, preston: Preston) -> str:
+def poco_notification_text(notification: dict, names: dict) -> str:
     """Returns a human-readable message of a structure notification"""
 
     match notification.get('type'):
         case "OrbitalAttacked":
-            return f"@everyone {await get_poco_name(notification, preston)} is under attack{await make_attribution(notification, preston)}!\n"
+            return f"@everyone {get_poco_name(notification, names)} is under attack{make_attribution(notification, names)}!\n"
         case "OrbitalReinforced":
-            return f"@everyone {await get_poco_name(notification, preston)} has ben reinforced{await make_attribution(notification, preston)}!\n{poco_timer_text(notification)}\n"
+            return f"@everyone {get_poco_name(notification, names)} has ben reinforced{make_attribution(notification, names)}!\n{poco_timer_text(notification)}\n"
         case _:
             return ""
 
 
+def notification_priority(notification: dict) -> Priority:
+    """returns the delivery priority of a notification"""
+    if notification.get('type') in combat_notification_types:
+        return Priority.COMBAT
+    return Priority.STATUS
+
+
+def latest_attack_time(notifications: list[dict]) -> datetime | None:
+    """returns the time of the most recent attack on a structure or None if there is none"""
+    return max(
+        (dateutil.parser.isoparse(n.get("timestamp")) for n in notifications if n.get('type') in hot_notification_types),
+        default=None,
+    )
+
+
 def is_poco_notification(notification: dict) -> bool:
     """returns true if a notification is about a structure"""
     # All structure notifications start with Structure... so we can use that
@@ -129,25 +161,221 @@ def is_structure_notification(notification: dict) -> bool:
     return "Structure" in notification.get('type')
 
 
-async def send_notification_message(notification, bot, user, authed_preston, identifier="<no identifier>"):
-    """For a notification from ESI take action and inform a user if required"""
-    notification_id = notification.get("notification_id")
-    timestamp = dateutil.parser.isoparse(notification.get("timestamp"))
+# Notifications are kept for this long, both in the database and in the in-memory index
+NOTIFICATION_RETENTION = timedelta(days=2)
+
+
+class NotificationIndex:
+    """Ids of handled notifications in hourly buckets of their timestamp, covering the retention window.
+    It only answers "already handled", anything it does not know is checked against the database."""
+
+    def __init__(self, window: timedelta, bucket_size: int = 3600):
+        self.window = window
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bucket(self, timestamp: datetime) -> int:
+        return int(timestamp.timestamp()) // self.bucket_size
+
+    def add(self, notification_id: str, timestamp: datetime):
+        self.buckets.setdefault(self.bucket(timestamp), set()).add(str(notification_id))
+
+    def contains(self, notification_id: str, timestamp: datetime) -> bool:
+        """Returns true if the notification was handled, counting hits and misses."""
+        found = str(notification_id) in self.buckets.get(self.bucket(timestamp), ())
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def prune(self):
+        """Drop buckets which are older than the window."""
+        oldest = self.bucket(datetime.now(timezone.utc) - self.window)
+        for bucket in [bucket for bucket in self.buckets if bucket < oldest]:
+            del self.buckets[bucket]
+
+    def statistics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "indexed": sum(len(ids) for ids in self.buckets.values()),
+            "buckets": len(self.buckets),
+        }
+
 
-    if timestamp < datetime.now(timezone.utc) - timedelta(days=1):
-        logger.debug(f"Skipping old notification {notification_id} for {identifier}")
+notification_index = NotificationIndex(NOTIFICATION_RETENTION)
+
+
+def notification_time(notification: dict) -> datetime:
+    return dateutil.parser.isoparse(notification.get("timestamp"))
+
+
+def index_notifications(notifications):
+    """Remember notifications as handled, once this is committed to the database."""
+    for notification in notifications:
+        notification_index.add(notification.get("notification_id"), notification_time(notification))
+
+
+def load_notification_index():
+    """Warm the in-memory index with the sent notifications of the retention window."""
+    threshold = datetime.now(timezone.utc) - NOTIFICATION_RETENTION
+    query = Notification.select(Notification.notification_id, Notification.timestamp).where(
+        Notification.sent & (Notification.timestamp >= threshold)
+    )
+    for row in query:
+        timestamp = row.timestamp
+        if isinstance(timestamp, str):
+            timestamp = dateutil.parser.isoparse(timestamp)
+        notification_index.add(row.notification_id, as_utc(timestamp))
+    logger.info(f"load_notification_index() indexed {notification_index.statistics()['indexed']} notifications.")
+
+
+def get_notification_statistics():
+    return notification_index.statistics()
+
+
+def recent_notifications(notifications, identifier="<no identifier>") -> dict[str, dict]:
+    """Returns the notifications of the last day by their id, older ones are never relayed"""
+    threshold = datetime.now(timezone.utc) - timedelta(days=1)
+    recent = {}
+    for notification in notifications:
+        notification_id = str(notification.get("notification_id"))
+        if notification_time(notification) < threshold:
+            logger.debug(f"Skipping old notification {notification_id} for {identifier}")
+            continue
+        recent[notification_id] = notification
+    return recent
+
+
+def store_notifications(notifications: dict[str, dict]) -> dict[str, bool]:
+    """Store notifications which are not known yet with one bulk insert.
+    Returns whether each of the notifications was sent before."""
+    known = {}
+    for ids in chunked(notifications.keys(), 500):
+        query = Notification.select(Notification.notification_id, Notification.sent).where(
+            Notification.notification_id.in_(ids)
+        )
+        for row in query:
+            known[row.notification_id] = known.get(row.notification_id, False) or row.sent
+
+    rows = [
+        {
+            "notification_id": notification_id,
+            "timestamp": notification_time(notification),
+        }
+        for notification_id, notification in notifications.items() if notification_id not in known
+    ]
+    with db.atomic():
+        for batch in chunked(rows, 100):
+            Notification.insert_many(batch).on_conflict_ignore().execute()
+
+    return {notification_id: known.get(notification_id, False) for notification_id in notifications}
+
+
+def new_notifications_of(notifications: dict[str, dict]) -> list[dict]:
+    """Returns the notifications which were not sent before according to the database"""
+    sent = store_notifications(notifications)
+    return [notification for notification_id, notification in notifications.items() if not sent[notification_id]]
+
+
+def mark_notifications_sent(notification_ids: list[str]):
+    for ids in chunked(notification_ids, 500):
+        Notification.update(sent=True).where(Notification.notification_id.in_(ids)).execute()
+
+
+def store_skipped_notifications(notifications: dict[str, dict]):
+    with db.atomic():
+        store_notifications(notifications)
+        mark_notifications_sent(list(notifications.keys()))
+
+
+async def skip_notifications(notifications):
+    """Mark recent structure notifications as sent, so that they are not relayed, e.g. after authorization."""
+    recent = recent_notifications(n for n in notifications if is_structure_notification(n))
+    if not recent:
         return
 
-    notif, created = Notification.get_or_create(notification_id=notification_id, timestamp=timestamp)
+    await run_db(store_skipped_notifications, recent)
+    index_notifications(recent.values())
+
 
+def claim_notifications(notification_ids: list[str]) -> list[str]:
+    """Mark notifications as sent unless that happened already, returns the ids this call marked.
+    The batch is claimed with one conditional update, so of overlapping polls only one claims each notification.
+    Databases without RETURNING select the unsent ones first, which needs a transaction holding the write lock."""
+    unsent = Notification.notification_id.in_(notification_ids) & ~Notification.sent
+    if db.returning_clause:
+        query = Notification.update(sent=True).where(unsent).returning(Notification.notification_id)
+        return list({row.notification_id for row in query.execute()})
+
+    claimed = list({row.notification_id for row in Notification.select(Notification.notification_id).where(unsent)})
+    if claimed:
+        Notification.update(sent=True).where(Notification.notification_id.in_(claimed)).execute()
+    return claimed
+
+
+def store_notification_messages(entries: dict[str, dict]) -> list[str]:
+    """Claim notifications and write the messages of the claimed ones to the outbox in one transaction.
+    Returns the ids of the claimed notifications."""
+    # SQLite takes the write lock right away, so no other poll claims between the select and the update
+    with db.atomic() if db.returning_clause else db.atomic("IMMEDIATE"):
+        claimed = claim_notifications(list(entries))
+        write_outbox([entries[notification_id] for notification_id in claimed])
+    return claimed
+
+
+def notification_message(notification, names: dict) -> str:
+    """For a notification from ESI returns the message to send, otherwise an empty string"""
     if is_structure_notification(notification):
-        if not notif.sent and len(message := await structure_notification_text(notification, authed_preston)) > 0:
-            if await send_background_message(bot, user, message, identifier):
-                notif.sent = True
-                notif.save()
+        return structure_notification_text(notification, names)
 
     if is_poco_notification(notification):
-        if not notif.sent and len(message := await poco_notification_text(notification, authed_preston)) > 0:
-            if await send_background_message(bot, user, message, identifier):
-                notif.sent = True
-                notif.save()
+        return poco_notification_text(notification, names)
+
+    return ""
+
+
+async def send_notification_messages(notifications, user, authed_preston: Preston, identifier="<no identifier>",
+                                     requester=None):
+    """For notifications from ESI take action and queue messages to a user if required.
+    The names of all new notifications are resolved at once before any message is built.
+    Messages are written to the outbox in the same transaction that claims the notifications as sent,
+    only for the notifications this call claimed, so overlapping polls never both relay one.
+    Notifications in the in-memory index are skipped without asking the database."""
+    candidates = {
+        notification_id: notification
+        for notification_id, notification in recent_notifications(notifications, identifier).items()
+        if not notification_index.contains(notification_id, notification_time(notification))
+    }
+    if not candidates:
+        return
+
+    new_notifications = await run_db(new_notifications_of, candidates)
+    if not new_notifications:
+        # All of them were sent before, e.g. skipped after authorization or relayed by another replica
+        index_notifications(candidates.values())
+        return
+
+    names = await resolve_names(
+        [key for n in new_notifications for key in name_keys(n)], authed_preston, requester
+    )
+
+    entries = {}
+    for notification in new_notifications:
+        if len(message := notification_message(notification, names)) > 0:
+            entries[str(notification.get("notification_id"))] = outbox_entry(
+                user, message, identifier, notification_priority(notification)
+            )
+
+    if entries:
+        claimed = await run_db(store_notification_messages, entries)
+        if len(claimed) < len(entries):
+            logger.debug(f"{len(entries) - len(claimed)} notifications for {identifier} were relayed by another poll.")
+
+    # Notifications which were sent before or have no message are handled as well, so they are skipped from now on too
+    index_notifications(candidates.values())
@@ -1,8 +1,10 @@
+import json
 import logging
 from datetime import datetime, timedelta, timezone
 
-from messaging import send_background_message
-from models import Structure
+from database import run_db
+from messaging import Priority, outbox_entry, write_outbox
+from models import Character, Structure, StructureSnapshot, StructureSubscription, Timer, as_utc, db
 
 # Mapping of EVE states to human-readable states
 state_mapping = {
@@ -21,6 +23,9 @@ state_mapping = {
     "unknown": "Unknown"
 }
 
+# States in which a structure is fought over, which moves its corporation into the hot polling tier
+reinforced_states = ["armor_reinforce", "armor_vulnerable", "hull_reinforce", "hull_vulnerable"]
+
 # Days when a fuel warning is sent
 fuel_warnings = [30, 15, 7, 3, 2, 1, 0]
 
@@ -64,6 +69,93 @@ def structure_info_text(structure: dict) -> str:
     return structure_message
 
 
+def snapshot_structure_ids(corporation_id) -> set[str] | None:
+    """Returns the ids of the structures in the latest snapshot of a corporation, None if it has none."""
+    snapshot = StructureSnapshot.get_or_none(StructureSnapshot.corporation_id == str(corporation_id))
+    if snapshot is None:
+        return None
+    return {str(structure.get("structure_id")) for structure in json.loads(snapshot.payload)}
+
+
+def forget_structures(structure_ids):
+    """Delete the timers, subscriptions and stored state of structures which are no longer listed by their corporation,
+    e.g. because they were destroyed, unanchored or transferred. Structures which come back are newly found."""
+    if structure_ids:
+        structure_ids = list(structure_ids)
+        Timer.delete().where(Timer.structure.in_(structure_ids)).execute()
+        StructureSubscription.delete().where(StructureSubscription.structure.in_(structure_ids)).execute()
+        Structure.delete().where(Structure.structure_id.in_(structure_ids)).execute()
+
+
+def store_structure_snapshot(corporation_id, structures: list[dict]):
+    """Keep the latest structures of a corporation as fetched from ESI, so that /info can answer without ESI.
+    Structures of the previous snapshot which are missing now are forgotten."""
+    with db.atomic():
+        if previous := snapshot_structure_ids(corporation_id):
+            forget_structures(previous - {str(structure.get("structure_id")) for structure in structures})
+
+        StructureSnapshot.insert(
+            corporation_id=str(corporation_id),
+            payload=json.dumps(structures, separators=(",", ":")),
+            fetched_at=datetime.now(timezone.utc),
+        ).on_conflict(
+            conflict_target=[StructureSnapshot.corporation_id],
+            preserve=[StructureSnapshot.payload, StructureSnapshot.fetched_at],
+        ).execute()
+
+
+def remove_structure_snapshot(corporation_id):
+    """Forget a corporation which has no characters left, together with all of its structures and their subscribers."""
+    with db.atomic():
+        if structure_ids := snapshot_structure_ids(corporation_id):
+            forget_structures(structure_ids)
+        StructureSnapshot.delete().where(StructureSnapshot.corporation_id == str(corporation_id)).execute()
+
+
+def confirm_structure_snapshot(corporation_id):
+    """Mark the snapshot of a corporation as current, e.g. after ESI reported its structures unchanged."""
+    StructureSnapshot.update(fetched_at=datetime.now(timezone.utc)).where(
+        StructureSnapshot.corporation_id == str(corporation_id)
+    ).execute()
+
+
+def load_structure_snapshots(corporation_ids) -> dict[str, tuple[list[dict], datetime]]:
+    """Returns the stored structures of corporations and when they were fetched, by corporation id."""
+    snapshots = StructureSnapshot.select().where(
+        StructureSnapshot.corporation_id.in_([str(corporation_id) for corporation_id in corporation_ids])
+    )
+    return {
+        snapshot.corporation_id: (
+            json.loads(snapshot.payload),
+            as_utc(snapshot.fetched_at),
+        )
+        for snapshot in snapshots
+    }
+
+
+def remove_structure_subscriptions(corporation_id, user_id):
+    """Stop structure messages of a corporation to a user, unless another of their characters can see its structures
+    or did not try yet. The structures of the corporation are taken from its latest snapshot."""
+    if Character.select().where(
+        (Character.user == user_id) & (Character.corporation_id == str(corporation_id))
+        & (Character.structure_access.is_null() | Character.structure_access)
+    ).exists():
+        return
+
+    structure_ids = snapshot_structure_ids(corporation_id)
+    if not structure_ids:
+        return
+
+    StructureSubscription.delete().where(
+        StructureSubscription.structure.in_(list(structure_ids)) & (StructureSubscription.user == user_id)
+    ).execute()
+
+
+def has_reinforced_structure(structures: list[dict]) -> bool:
+    """Returns true if any of the structures is reinforced or has a timer running"""
+    return any(structure.get('state') in reinforced_states for structure in structures)
+
+
 def next_fuel_warning(structure: dict) -> int:
     """Returns the next fuel warning level a structure is currently on"""
     fuel_expires = to_datetime(structure.get('fuel_expires'))
@@ -78,8 +170,55 @@ def next_fuel_warning(structure: dict) -> int:
     return -1
 
 
-async def send_structure_message(structure, bot, user, identifier="<no identifier>"):
-    """For a structure state if there are any changes, take action and inform a user"""
+def fuel_warning_message(structure, last_fuel_warning, current_fuel_warning):
+    """Returns the message and priority for a structure dropping below the fuel warning level last_fuel_warning,
+    or None if no warning is needed because the structure is still anchoring"""
+    if current_fuel_warning == -1:
+        if structure.get('state') in ["anchoring", "anchor_vulnerable"]:
+            return None
+        message = f"Final warning, structure {structure.get('name')} ran out of fuel:\n{structure_info_text(structure)}"
+        return message, Priority.STATUS
+    message = f"{last_fuel_warning}-day warning, structure {structure.get('name')} is running low on fuel:\n{structure_info_text(structure)}"
+    return message, Priority.HOUSEKEEPING
+
+
+def structure_changes(structure, last_state, last_fuel_warning):
+    """Compare a structure from ESI with a previously seen state and fuel warning level.
+    Returns the messages to send as (text, priority) and the state and fuel warning level to remember."""
+    messages = []
+    state = structure.get("state")
+
+    if last_state != state:
+        message = f"Structure {structure.get('name')} changed state:\n{structure_info_text(structure)}"
+        messages.append((message, Priority.STATUS))
+
+    current_fuel_warning = next_fuel_warning(structure)
+
+    if last_fuel_warning is None:  # Maybe remove this clause?
+        return messages, state, current_fuel_warning
+
+    elif current_fuel_warning > last_fuel_warning:
+        if last_fuel_warning == -1:
+            message = f"Structure {structure.get('name')} got initially fueled with:\n{structure_info_text(structure)}"
+        else:
+            message = f"Structure {structure.get('name')} has been refueled:\n{structure_info_text(structure)}"
+        messages.append((message, Priority.HOUSEKEEPING))
+        return messages, state, current_fuel_warning
+
+    elif current_fuel_warning < last_fuel_warning:
+        if (warning := fuel_warning_message(structure, last_fuel_warning, current_fuel_warning)) is None:
+            return messages, state, last_fuel_warning
+        messages.append(warning)
+        return messages, state, current_fuel_warning
+
+    return messages, state, last_fuel_warning
+
+
+def structure_messages(structure, subscribers, identifier="<no identifier>") -> list[dict]:
+    """For a structure state if there are any changes, update the stored state of the structure and of
+    every subscribed user and return outbox entries for each of them.
+    The comparison is only done once for every distinct previously seen state, and users sharing a callback channel
+    receive each message there once."""
 
     structure_db, created = Structure.get_or_create(
         structure_id=structure.get('structure_id'),
@@ -89,44 +228,66 @@ async def send_structure_message(structure, bot, user, identifier="<no identifie
         },
     )
 
-    if created:
-        message = f"Structure {structure.get('name')} newly found in state:\n{structure_info_text(structure)}"
-        await send_background_message(bot, user, message, identifier)
+    previous = (structure_db.last_state, structure_db.last_fuel_warning)
+    subscriptions = {subscription.user_id: subscription for subscription in structure_db.subscriptions}
 
-    else:
-        if structure_db.last_state != structure.get("state"):
-            message = f"Structure {structure.get('name')} changed state:\n{structure_info_text(structure)}"
-            if await send_background_message(bot, user, message, identifier):
-                structure_db.last_state = structure.get("state")
-                structure_db.save()
+    entries = {}
+    changes = {}
+    for user in subscribers:
+        subscription = subscriptions.pop(user.user_id, None)
+        if subscription is None:
+            # New subscribers start from the last known state, so they only receive new events
+            subscription = StructureSubscription.create(
+                structure=structure_db, user=user,
+                last_state=structure_db.last_state, last_fuel_warning=structure_db.last_fuel_warning,
+            )
+            if created:
+                message = f"Structure {structure.get('name')} newly found in state:\n{structure_info_text(structure)}"
+                entries.setdefault((str(user.callback_channel_id), message), outbox_entry(user, message, identifier))
+                continue
+
+        seen = (subscription.last_state, subscription.last_fuel_warning)
+        if seen not in changes:
+            changes[seen] = structure_changes(structure, *seen)
+        messages, state, fuel_warning = changes[seen]
+
+        for message, priority in messages:
+            entries.setdefault(
+                (str(user.callback_channel_id), message), outbox_entry(user, message, identifier, priority)
+            )
+
+        if (state, fuel_warning) != seen:
+            subscription.last_state = state
+            subscription.last_fuel_warning = fuel_warning
+            subscription.save()
 
-        current_fuel_warning = next_fuel_warning(structure)
+    # Users which no longer have a character in the corporation that can see its structures stop receiving events
+    if subscriptions:
+        StructureSubscription.delete().where(
+            StructureSubscription.id.in_([subscription.id for subscription in subscriptions.values()])
+        ).execute()
 
-        if structure_db.last_fuel_warning is None:  # Maybe remove this clause?
-            structure_db.last_fuel_warning = current_fuel_warning
+    if not created:
+        if previous not in changes:
+            changes[previous] = structure_changes(structure, *previous)
+        _, state, fuel_warning = changes[previous]
+        if (state, fuel_warning) != previous:
+            structure_db.last_state = state
+            structure_db.last_fuel_warning = fuel_warning
             structure_db.save()
-            return
-
-        elif current_fuel_warning > structure_db.last_fuel_warning:
-            if structure_db.last_fuel_warning == -1:
-                message = f"Structure {structure.get('name')} got initially fueled with:\n{structure_info_text(structure)}"
-            else:
-                message = f"Structure {structure.get('name')} has been refueled:\n{structure_info_text(structure)}"
-            if await send_background_message(bot, user, message, identifier):
-                structure_db.last_fuel_warning = current_fuel_warning
-                structure_db.save()
-                return
-
-        elif current_fuel_warning < structure_db.last_fuel_warning:
-            state = structure.get('state')
-            if current_fuel_warning == -1:
-                if state in ["anchoring", "anchor_vulnerable"]:
-                    return
-                else:
-                    message = f"Final warning, structure {structure.get('name')} ran out of fuel:\n{structure_info_text(structure)}"
-            else:
-                message = f"{structure_db.last_fuel_warning}-day warning, structure {structure.get('name')} is running low on fuel:\n{structure_info_text(structure)}"
-            if await send_background_message(bot, user, message, identifier):
-                structure_db.last_fuel_warning = current_fuel_warning
-                structure_db.save()
-                return
+
+    return list(entries.values())
+
+
+def store_structure_messages(structures, subscribers, identifier="<no identifier>"):
+    """Write state changes of structures and their messages in one transaction."""
+    with db.atomic():
+        entries = []
+        for structure in structures:
+            entries.extend(structure_messages(structure, subscribers, identifier))
+        write_outbox(entries)
+
+
+async def send_structure_messages(structures, subscribers, identifier="<no identifier>"):
+    """For structure states from ESI take action and queue messages to all subscribed users if required."""
+    await run_db(store_structure_messages, structures, subscribers, identifier)
@@ -0,0 +1,195 @@
+import heapq
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+from actions.structure import next_fuel_warning, fuel_warning_message, structure_info_text, to_datetime
+from actions.structure import snapshot_structure_ids
+from concurrency import corporation_lock
+from database import run_db
+from messaging import Priority, one_per_channel, outbox_entry, write_outbox
+from models import Structure, StructureSubscription, Timer, User, as_utc, db
+from partitions import owns, partition_of
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.timer')
+
+FUEL = "fuel"
+REINFORCE = "reinforce"
+
+# Minutes before a reinforcement timer runs out at which a reminder is sent
+reinforce_reminders = [60, 15]
+
+# Timers which should have fired longer than this ago, e.g. while the bot was down, are dropped
+TIMER_GRACE = timedelta(hours=1)
+
+timer_heap = []
+
+
+def timer_corporation(timer: Timer) -> str:
+    return str(json.loads(timer.snapshot).get("corporation_id"))
+
+
+def plan_timer(timer: Timer):
+    """Add a stored timer to the in-process heap."""
+    heapq.heappush(timer_heap, (as_utc(timer.fire_at).timestamp(), timer.id, timer_corporation(timer)))
+
+
+def structure_timers(structure: dict) -> list[dict]:
+    """Returns the upcoming fuel threshold and reinforcement reminder of a structure snapshot"""
+    now = datetime.now(timezone.utc)
+    snapshot = json.dumps(structure, separators=(",", ":"))
+    timers = []
+
+    fuel_expires = to_datetime(structure.get('fuel_expires'))
+    fuel_warning = next_fuel_warning(structure)
+    if fuel_expires is not None and fuel_warning >= 0:
+        timers.append({
+            "kind": FUEL,
+            "level": fuel_warning,
+            "fire_at": fuel_expires - timedelta(days=fuel_warning),
+        })
+
+    state_expires = to_datetime(structure.get('state_timer_end'))
+    if structure.get('state') in ["armor_reinforce", "hull_reinforce"] and state_expires is not None:
+        for minutes in reinforce_reminders:
+            fire_at = state_expires - timedelta(minutes=minutes)
+            if fire_at > now:
+                timers.append({"kind": REINFORCE, "level": minutes, "fire_at": fire_at})
+
+    return [
+        {"structure": structure.get('structure_id'), "snapshot": snapshot, **timer}
+        for timer in timers
+    ]
+
+
+def replace_structure_timers(structures: list[dict]) -> list[Timer]:
+    """Replace the stored timers of structures with the ones of their latest snapshot.
+    Returns the new timers, which should be planned once the transaction is committed."""
+    structure_ids = [str(structure.get('structure_id')) for structure in structures]
+    if structure_ids:
+        Timer.delete().where(Timer.structure.in_(structure_ids)).execute()
+
+    timers = []
+    for structure in structures:
+        for row in structure_timers(structure):
+            timers.append(Timer.create(**row))
+    return timers
+
+
+def store_structure_timers(structures: list[dict]) -> list[Timer]:
+    with db.atomic():
+        return replace_structure_timers(structures)
+
+
+async def update_structure_timers(structures: list[dict]):
+    """Store and plan the timers of freshly fetched structures, the structures must be stored already."""
+    for timer in await run_db(store_structure_timers, structures):
+        plan_timer(timer)
+
+
+def stored_timers() -> list[Timer]:
+    return list(Timer.select())
+
+
+async def load_timers(partitions: set[int] | None = None):
+    """Plan the stored timers of the corporations of this replica, so that they survive restarts.
+    If partitions are given, only the timers of these partitions are added, e.g. after taking them over."""
+    if partitions is None:
+        timer_heap.clear()
+
+    for timer in await run_db(stored_timers):
+        corporation_id = timer_corporation(timer)
+        if owns(corporation_id) and (partitions is None or partition_of(corporation_id) in partitions):
+            plan_timer(timer)
+    logger.info(f"load_timers() planned {len(timer_heap)} timers.")
+
+
+def reinforce_reminder_message(structure: dict, minutes: int) -> str:
+    if minutes >= 60:
+        remaining = f"{minutes // 60}h"
+    else:
+        remaining = f"{minutes}m"
+    return f"@everyone Structure {structure.get('name')} comes out of reinforcement in {remaining}:\n{structure_info_text(structure)}"
+
+
+def fire_timer(timer: Timer) -> list[Timer]:
+    """Queue the messages of a due timer for every subscribed user and returns the follow-up timers to plan."""
+    structure = json.loads(timer.snapshot)
+
+    with db.atomic():
+        # Another replica fired the timer already, e.g. while its partition moved
+        if not timer.delete_instance():
+            return []
+
+        # Fuel timers plan their follow-ups from their own snapshot, so they would go on after the structure is gone
+        listed = snapshot_structure_ids(timer_corporation(timer))
+        if listed is None or str(timer.structure_id) not in listed:
+            logger.info(f"Dropping {timer}, its structure is no longer listed by its corporation.")
+            return []
+
+        if datetime.now(timezone.utc) - as_utc(timer.fire_at) > TIMER_GRACE:
+            logger.info(f"Dropping {timer}, it is too late to fire it.")
+            return replace_structure_timers([structure]) if timer.kind == FUEL else []
+
+        entries = []
+        subscriptions = (
+            StructureSubscription
+            .select(StructureSubscription, User)
+            .join(User)
+            .where(StructureSubscription.structure == timer.structure_id)
+        )
+
+        if timer.kind == FUEL:
+            current_fuel_warning = next_fuel_warning(structure)
+            warning = fuel_warning_message(structure, timer.level, current_fuel_warning)
+
+            # Only users which were not warned yet, polls compare against the same level afterward
+            warned = [s for s in subscriptions if s.last_fuel_warning == timer.level]
+            if warning is not None and warned:
+                message, priority = warning
+                entries.extend(
+                    outbox_entry(user, message, f"timer {timer.id}", priority)
+                    for user in one_per_channel(s.user for s in warned)
+                )
+                StructureSubscription.update(last_fuel_warning=current_fuel_warning).where(
+                    StructureSubscription.id.in_([s.id for s in warned])
+                ).execute()
+                Structure.update(last_fuel_warning=current_fuel_warning).where(
+                    (Structure.structure_id == timer.structure_id) & (Structure.last_fuel_warning == timer.level)
+                ).execute()
+
+            write_outbox(entries)
+            return replace_structure_timers([structure])
+
+        message = reinforce_reminder_message(structure, timer.level)
+        entries.extend(
+            outbox_entry(user, message, f"timer {timer.id}", Priority.COMBAT)
+            for user in one_per_channel(s.user for s in subscriptions)
+        )
+        write_outbox(entries)
+        return []
+
+
+def fire_stored_timer(timer_id) -> list[Timer]:
+    """Fire a timer if it was not replaced in the meantime and returns its follow-up timers."""
+    timer = Timer.get_or_none(Timer.id == timer_id)
+    if timer is None:
+        return []
+
+    logger.debug(f"Firing {timer}.")
+    return fire_timer(timer)
+
+
+async def fire_due_timers():
+    """Fire every timer on the heap which is due, while no structure poll of its corporation is writing."""
+    now = datetime.now(timezone.utc).timestamp()
+    while timer_heap and timer_heap[0][0] <= now:
+        _, timer_id, corporation_id = heapq.heappop(timer_heap)
+        if not owns(corporation_id):
+            # The partition moved to another replica, which planned the timer itself
+            continue
+        async with corporation_lock(corporation_id):
+            follow_ups = await run_db(fire_stored_timer, timer_id)
+        for follow_up in follow_ups:
+            plan_timer(follow_up)
@@ -0,0 +1,104 @@
+import aiohttp
+import asyncio
+import jwt
+import logging
+import time
+from collections import defaultdict
+
+from preston import Preston
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.authentication')
+
+# Access tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 120
+
+# EVE SSO signing keys, used to verify access tokens locally
+JWKS_URL = "https://login.eveonline.com/oauth/jwks"
+JWKS_CACHE_TIME = 24 * 60 * 60
+JWKS_MIN_REFETCH_TIME = 5 * 60
+TOKEN_ISSUERS = ["https://login.eveonline.com", "login.eveonline.com"]
+
+authed_prestons = {}
+authentication_locks = defaultdict(asyncio.Lock)
+
+signing_keys = {}
+signing_keys_fetched_at = 0
+signing_keys_lock = asyncio.Lock()
+
+
+def is_fresh(authed_preston: Preston) -> bool:
+    """Returns true if the access token of an authenticated preston is valid for a while longer."""
+    access_expiration = getattr(authed_preston, "access_expiration", None)
+    return access_expiration is not None and access_expiration - REFRESH_MARGIN > time.time()
+
+
+async def authenticate_character(preston: Preston, character) -> Preston:
+    """Get an authenticated preston for a character, reusing the access token until shortly before it expires.
+    Raises aiohttp.ClientResponseError just like preston.authenticate_from_token if the refresh fails."""
+    character_id = str(character.character_id)
+    async with authentication_locks[character_id]:
+        authed_preston = authed_prestons.get(character_id)
+        if authed_preston is not None and authed_preston.refresh_token == character.token and is_fresh(authed_preston):
+            logger.debug(f"Reusing access token for {character}.")
+            return authed_preston
+
+        authed_prestons.pop(character_id, None)
+        authed_preston = await preston.authenticate_from_token(character.token)
+        authed_prestons[character_id] = authed_preston
+        return authed_preston
+
+
+def forget_character(character_id):
+    """Drop the cached access token of a character, e.g. after it was re-authorized or revoked."""
+    authed_prestons.pop(str(character_id), None)
+
+
+async def get_signing_key(key_id: str):
+    """Get an SSO signing key from the cached key set, fetching the key set again if it is old or lacks the key."""
+    global signing_keys_fetched_at
+
+    async with signing_keys_lock:
+        age = time.time() - signing_keys_fetched_at
+        if age > JWKS_CACHE_TIME or (key_id not in signing_keys and age > JWKS_MIN_REFETCH_TIME):
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=6)) as session:
+                async with session.get(JWKS_URL) as response:
+                    response.raise_for_status()
+                    key_set = await response.json()
+
+            signing_keys.clear()
+            for key in key_set.get("keys", []):
+                if "kid" in key:
+                    signing_keys[key["kid"]] = jwt.PyJWK(key)
+            signing_keys_fetched_at = time.time()
+            logger.debug(f"Fetched {len(signing_keys)} SSO signing keys.")
+
+    if key_id not in signing_keys:
+        raise KeyError(f"Unknown SSO signing key {key_id}")
+    return signing_keys[key_id]
+
+
+async def character_from_token(authed_preston: Preston) -> dict:
+    """Returns the character id and name from the claims of the access token, like preston.whoami() does.
+    The token is verified locally against the cached SSO key set, and whoami() is only used as a fallback."""
+    try:
+        access_token = authed_preston.access_token
+        signing_key = await get_signing_key(jwt.get_unverified_header(access_token)["kid"])
+        claims = jwt.decode(
+            access_token,
+            signing_key.key,
+            algorithms=[signing_key.algorithm_name],
+            audience=authed_preston.client_id,
+            options={"verify_iss": False},
+            leeway=10,
+        )
+        if claims.get("iss") not in TOKEN_ISSUERS:
+            raise jwt.InvalidIssuerError(f"Unexpected token issuer {claims.get('iss')}")
+
+        return {
+            "character_id": int(claims["sub"].split(":")[-1]),
+            "character_name": claims.get("name"),
+        }
+    except Exception as e:
+        logger.warning(f"character_from_token() could not decode access token locally, falling back to whoami: {e}")
+        return await authed_preston.whoami()
@@ -0,0 +1,35 @@
+import asyncio
+import os
+from collections import defaultdict
+
+# Maximum number of characters whose notifications are polled at the same time
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "20"))
+
+# Maximum number of corporations whose structures are polled at the same time.
+# Structure polls have their own slots, so that they never hold up notification polls.
+STRUCTURE_POLL_CONCURRENCY = int(os.getenv("STRUCTURE_POLL_CONCURRENCY", "10"))
+
+# Maximum number of ESI calls a single command like /info or /characters makes at the same time
+COMMAND_CONCURRENCY = int(os.getenv("COMMAND_CONCURRENCY", "5"))
+
+notification_slots = asyncio.Semaphore(POLL_CONCURRENCY)
+structure_slots = asyncio.Semaphore(STRUCTURE_POLL_CONCURRENCY)
+
+corporation_locks = defaultdict(asyncio.Lock)
+
+
+def corporation_lock(corporation_id) -> asyncio.Lock:
+    """Returns the lock guarding the stored structures, subscriptions and timers of one corporation."""
+    return corporation_locks[str(corporation_id)]
+
+
+async def bounded_gather(coroutines, limit: int = POLL_CONCURRENCY):
+    """Run coroutines concurrently with at most limit of them in flight at the same time.
+    Exceptions are returned in place of results, so one failing coroutine does not cancel the others."""
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from peewee import SqliteDatabase
+
+from models import db
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.database')
+
+# SQLite only allows one writer at a time, so all of its queries run on a single thread
+DB_WORKERS = 1 if isinstance(db, SqliteDatabase) else int(os.getenv("DB_WORKERS", "4"))
+
+# Database work taking longer than this many seconds is logged
+SLOW_QUERY_TIME = float(os.getenv("SLOW_QUERY_TIME", "0.5"))
+
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="database")
+
+query_statistics = defaultdict(lambda: {"calls": 0, "total_time": 0.0, "max_time": 0.0, "total_wait": 0.0})
+statistics_lock = threading.Lock()
+
+
+def record_query(name: str, wait: float, duration: float):
+    with statistics_lock:
+        statistics = query_statistics[name]
+        statistics["calls"] += 1
+        statistics["total_time"] += duration
+        statistics["max_time"] = max(statistics["max_time"], duration)
+        statistics["total_wait"] += wait
+
+    if duration > SLOW_QUERY_TIME:
+        logger.warning(f"{name} took {duration:.2f} seconds.")
+
+
+def work_name(function) -> str:
+    """Returns a name to group database work by, e.g. "Timer ModelUpdate.execute" for query methods."""
+    owner = getattr(function, "__self__", None)
+    model = getattr(owner, "model", None)
+    if model is not None:
+        return f"{model.__name__} {type(owner).__name__}.{function.__name__}"
+    if isinstance(owner, type):
+        return f"{owner.__name__}.{function.__name__}"
+    return getattr(function, "__qualname__", repr(function))
+
+
+async def run_db(function, *args, **kwargs):
+    """Run database work on the database executor so that it does not block the event loop.
+    function is any callable doing peewee queries, e.g. query.execute or a function opening a transaction."""
+    name = work_name(function)
+    queued_at = time.monotonic()
+
+    def run():
+        started_at = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record_query(name, started_at - queued_at, time.monotonic() - started_at)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, run)
+
+
+def get_database_statistics():
+    """Returns how often and how long each kind of database work ran, and how long it waited for a worker."""
+    with statistics_lock:
+        return {
+            "workers": DB_WORKERS,
+            "queries": {
+                name: {
+                    **statistics,
+                    "average_time": statistics["total_time"] / statistics["calls"],
+                    "average_wait": statistics["total_wait"] / statistics["calls"],
+                }
+                for name, statistics in query_statistics.items()
+            },
+        }
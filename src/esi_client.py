@@ -0,0 +1,313 @@
+import aiohttp
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from preston import Preston
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.esi')
+
+ESI_BASE_URL = "https://esi.evetech.net/latest"
+USER_AGENT = "Structure timer discord bot by <larynx.austrene@gmail.com>"
+ESI_TIMEOUT = 6
+ESI_RETRIES = 3
+
+# Paths of the ESI operations which are polled with conditional requests
+operation_paths = {
+    "get_characters_character_id_notifications": "/characters/{character_id}/notifications/",
+    "get_corporations_corporation_id_structures": "/corporations/{corporation_id}/structures/",
+}
+
+# Requests per second shared by all ESI calls, and how many may be sent at once after a quiet period
+ESI_RATE_LIMIT = float(os.getenv("ESI_RATE_LIMIT", "20"))
+ESI_BURST = int(os.getenv("ESI_BURST", "40"))
+
+# Remaining ESI errors in the current window below which non-critical calls are slowed down, paused,
+# and below which all calls are paused until the window resets
+ERROR_LIMIT_SLOW = int(os.getenv("ERROR_LIMIT_SLOW", "50"))
+ERROR_LIMIT_PAUSE = int(os.getenv("ERROR_LIMIT_PAUSE", "20"))
+ERROR_LIMIT_OPEN = int(os.getenv("ERROR_LIMIT_OPEN", "5"))
+
+# ESI allows 100 errors per window of 60 seconds
+ERROR_LIMIT = 100
+ERROR_WINDOW = 60
+
+# Slowed down non-critical calls use this many tokens each
+SLOW_COST = 4
+
+# Seconds for which a lookup that ESI refused is not tried again
+NEGATIVE_CACHE_TIME = int(os.getenv("NEGATIVE_CACHE_TIME", "300"))
+NEGATIVE_CACHE_SIZE = 1000
+
+session = None
+etags = {}
+esi_statistics = {"hits": 0, "misses": 0, "shared": 0, "negative_hits": 0}
+
+in_flight = {}
+failed_lookups = {}
+
+
+@dataclass
+class EsiResponse:
+    key: tuple
+    data: list | dict | None
+    etag: str | None
+    expires: datetime | None
+
+    @property
+    def modified(self) -> bool:
+        return self.data is not None
+
+
+class EsiLimiter:
+    """Token bucket shared by all ESI calls, combined with a circuit breaker driven by the ESI error limit.
+    Non-critical calls (e.g. name lookups) are slowed down and then paused as the error budget runs low,
+    before critical calls (polls, authorization) have to wait for the error window to reset."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+        self.error_remain = ERROR_LIMIT
+        self.error_reset_at = time.time() + ERROR_WINDOW
+
+        self.calls = 0
+        self.errors = 0
+        self.waited = 0.0
+        self.trips = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reset_window(self):
+        if time.time() >= self.error_reset_at:
+            self.error_remain = ERROR_LIMIT
+            self.error_reset_at = time.time() + ERROR_WINDOW
+
+    @property
+    def state(self) -> str:
+        """Returns closed, throttled (non-critical calls slowed), paused (non-critical calls wait) or open."""
+        self.reset_window()
+        if self.error_remain <= ERROR_LIMIT_OPEN:
+            return "open"
+        if self.error_remain <= ERROR_LIMIT_PAUSE:
+            return "paused"
+        if self.error_remain <= ERROR_LIMIT_SLOW:
+            return "throttled"
+        return "closed"
+
+    async def acquire(self, critical: bool = True):
+        """Wait until a call may be sent to ESI."""
+        started_at = time.monotonic()
+        while (state := self.state) == "open" or (state == "paused" and not critical):
+            await asyncio.sleep(max(0.1, self.error_reset_at - time.time()))
+
+        cost = min(self.burst, SLOW_COST) if state == "throttled" and not critical else 1
+        async with self.lock:
+            self.refill()
+            if self.tokens < cost:
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= cost
+
+        self.calls += 1
+        self.waited += time.monotonic() - started_at
+
+    def record(self, status: int, headers=None):
+        """Update the error budget from the headers of an ESI response, or estimate it if they are missing."""
+        if status >= 400 and status != 304:
+            self.errors += 1
+
+        try:
+            remain = int(headers["X-ESI-Error-Limit-Remain"])
+            reset = int(headers["X-ESI-Error-Limit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            self.reset_window()
+            if status >= 400:
+                self.error_remain = max(0, self.error_remain - 1)
+            remain, reset = self.error_remain, self.error_reset_at - time.time()
+
+        if status == 420:
+            remain = 0
+
+        was_open = self.state == "open"
+        self.error_remain = remain
+        self.error_reset_at = time.time() + reset
+        if not was_open and self.state == "open":
+            self.trips += 1
+            logger.warning(f"ESI error limit almost reached, pausing all calls for {int(reset)} seconds.")
+
+    def statistics(self) -> dict:
+        return {
+            "state": self.state,
+            "error_remain": self.error_remain,
+            "error_reset_in": max(0.0, self.error_reset_at - time.time()),
+            "tokens": self.tokens,
+            "calls": self.calls,
+            "errors": self.errors,
+            "average_wait": self.waited / self.calls if self.calls else 0.0,
+            "trips": self.trips,
+        }
+
+
+esi_limiter = EsiLimiter(ESI_RATE_LIMIT, ESI_BURST)
+
+
+async def esi_call(function, *args, critical: bool = True, **kwargs):
+    """Run a preston call like preston.get_op or preston.post_op through the shared ESI limiter.
+    Calls which are not critical for relaying events should pass critical=False."""
+    await esi_limiter.acquire(critical)
+    try:
+        result = await function(*args, **kwargs)
+    except aiohttp.ClientResponseError as exp:
+        esi_limiter.record(exp.status, exp.headers)
+        raise
+    esi_limiter.record(200)
+    return result
+
+
+def remember_failure(key, exception: aiohttp.ClientResponseError):
+    """Cache a refused lookup for a short time, dropping expired failures once the cache grows."""
+    if len(failed_lookups) >= NEGATIVE_CACHE_SIZE:
+        now = time.time()
+        for expired in [k for k, (until, _) in failed_lookups.items() if until <= now]:
+            del failed_lookups[expired]
+    failed_lookups[key] = (time.time() + NEGATIVE_CACHE_TIME, exception)
+
+
+async def single_flight(key, function, *args, failure_key=None, **kwargs):
+    """Run an ESI lookup like esi_call, sharing one request between all callers asking for the same key at once.
+    If ESI refuses the lookup, the error is raised again for NEGATIVE_CACHE_TIME seconds without asking ESI.
+    Lookups which are refused depending on who asks should pass a failure_key including the requester,
+    so that the refusal is only cached for them."""
+    failure_key = key if failure_key is None else failure_key
+    if (failure := failed_lookups.get(failure_key)) is not None:
+        until, exception = failure
+        if until > time.time():
+            esi_statistics["negative_hits"] += 1
+            raise exception
+        del failed_lookups[failure_key]
+
+    if key in in_flight:
+        esi_statistics["shared"] += 1
+        return await asyncio.shield(in_flight[key])
+
+    def finished(future):
+        in_flight.pop(key, None)
+        if not future.cancelled() and isinstance(future.exception(), aiohttp.ClientResponseError):
+            remember_failure(failure_key, future.exception())
+
+    # The request is shielded, so that a cancelled caller does not cancel it for everybody else
+    future = asyncio.ensure_future(function(*args, **kwargs))
+    future.add_done_callback(finished)
+    in_flight[key] = future
+    return await asyncio.shield(future)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared HTTP session for ESI requests."""
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=ESI_TIMEOUT),
+            headers={"User-Agent": USER_AGENT, "Accept": "application/json"},
+        )
+    return session
+
+
+def get_expires(headers) -> datetime | None:
+    """Returns the time until which ESI caches a response."""
+    try:
+        return parsedate_to_datetime(headers["Expires"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+async def request(url: str, headers: dict, params: dict | None = None):
+    """Run a GET request against ESI, retrying server side failures with exponential backoff.
+    Returns status, headers and the decoded body (None for 304).
+    Raises aiohttp.ClientResponseError for client side failures like preston does."""
+    for attempt in range(ESI_RETRIES):
+        await esi_limiter.acquire()
+        try:
+            async with get_session().get(url, headers=headers, params=params) as response:
+                esi_limiter.record(response.status, response.headers)
+                if response.status == 304:
+                    return response.status, response.headers, None
+                if response.status < 400:
+                    return response.status, response.headers, await response.json()
+
+                message = await response.text()
+                if response.status not in [500, 502, 503, 504]:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history,
+                        status=response.status, message=message, headers=response.headers,
+                    )
+        except asyncio.TimeoutError:
+            pass  # Just try again
+
+        await asyncio.sleep(2 ** attempt)
+
+    raise aiohttp.ClientConnectionError("ESI could not complete the request.")
+
+
+async def get_op_conditional(authed_preston: Preston, requester_id, op_id: str, **kwargs) -> EsiResponse:
+    """Fetch an ESI operation as the character requester_id, sending the ETag of its last processed response.
+    If ESI answers 304 Not Modified the returned response has no data and modified is False.
+    Responses with several pages are fetched unconditionally, as the ETag only covers the first page.
+    Call mark_processed once the data has been handled, so that it is not skipped if handling fails."""
+    key = (op_id, tuple(sorted(kwargs.items())), str(requester_id))
+    url = ESI_BASE_URL + operation_paths[op_id].format(**kwargs)
+
+    headers = {"Authorization": f"Bearer {authed_preston.access_token}"}
+    if key in etags:
+        headers["If-None-Match"] = etags[key]
+
+    status, response_headers, data = await request(url, headers)
+    expires = get_expires(response_headers)
+
+    if status == 304:
+        esi_statistics["hits"] += 1
+        return EsiResponse(key, None, etags.get(key), expires)
+
+    esi_statistics["misses"] += 1
+
+    # Paginated endpoints return the remaining pages separately. A change on a later page would be hidden
+    # by a 304 for the first one, so their ETag is not kept
+    pages = int(response_headers.get("X-Pages", 1))
+    if pages > 1:
+        etags.pop(key, None)
+        for page in range(2, pages + 1):
+            _, _, page_data = await request(url, {"Authorization": headers["Authorization"]}, params={"page": page})
+            data.extend(page_data)
+        return EsiResponse(key, data, None, expires)
+
+    return EsiResponse(key, data, response_headers.get("ETag"), expires)
+
+
+def mark_processed(response: EsiResponse):
+    """Remember the ETag of a response once its data was handled."""
+    if response.etag is not None:
+        etags[response.key] = response.etag
+
+
+def get_esi_statistics():
+    """Returns how many conditional requests were answered with 304 Not Modified."""
+    total = esi_statistics["hits"] + esi_statistics["misses"]
+    return {
+        **esi_statistics,
+        "hit_rate": esi_statistics["hits"] / total if total else 0.0,
+        "cached_etags": len(etags),
+        "in_flight": len(in_flight),
+        "negative_cached": len(failed_lookups),
+        "limiter": esi_limiter.statistics(),
+    }
@@ -6,39 +6,57 @@ import json
 import logging
 import os
 import secrets
+from datetime import datetime, UTC
 from discord import Interaction, app_commands
 from discord.ext import commands
 from io import BytesIO
 from preston import Preston
 
 from actions.esi import esi_permission_warning, channel_warning, handle_structure_error, updated_channel_warning
-from actions.esi import send_foreground_warning
-from actions.structure import structure_info_text
-from messaging import send_background_message
-from models import User, Challenge, Character, initialize_database
-from relay import notification_pings, status_pings, no_auth_pings, cleanup_old_notifications
-from webserver import webserver
+from actions.esi import send_foreground_warning, record_structure_access
+from actions.notification import load_notification_index
+from actions.structure import structure_info_text, load_structure_snapshots, store_structure_snapshot
+from actions.structure import remove_structure_subscriptions
+from actions.timer import load_timers
+from authentication import authenticate_character, character_from_token, forget_character
+from concurrency import COMMAND_CONCURRENCY, bounded_gather
+from database import run_db
+from esi_client import USER_AGENT, esi_call
+from messaging import DELIVERY_CONCURRENCY, MAX_RATELIMIT_TIMEOUT, send_background_message, invalidate_channel
+from messaging import resolve_channel
+from models import User, Challenge, Character, Outbox, StructureSubscription, db, initialize_database
+from names import CHARACTER, resolve_names
+from partitions import release_partitions
+from relay import notification_pings, status_pings, no_auth_pings, cleanup_old_notifications, outbox_pings
+from relay import timer_pings, partition_pings, load_user_characters
+from scheduler import load_characters, load_schedules, character_removed
+from webserver import webserver, metrics_server
 
 # Configure the logger
 logger = logging.getLogger('discord.timer')
 log_level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
 logger.setLevel(log_level)
 
+# Which part of the bot this process runs, so that each part can be scaled on its own:
+# "gateway" answers commands and delivers the outbox, "poller" polls ESI and only writes to the outbox,
+# "sender" only delivers the outbox and "all" runs everything in one process.
+ROLE = os.getenv("ROLE", "all")
+
 # Initialize the database
 initialize_database()
 
 
 # Setup ESI connection
 async def refresh_token_callback(preston):
-    character_data = await preston.whoami()
+    character_data = await character_from_token(preston)
     if "character_id" in character_data:
-        character = Character.get(character_id=character_data.get("character_id"))
-        character.token = preston.refresh_token
-        character.save()
+        await run_db(Character.update(token=preston.refresh_token).where(
+            Character.character_id == character_data.get("character_id")
+        ).execute)
 
 
 base_preston = Preston(
-    user_agent="Structure timer discord bot by <larynx.austrene@gmail.com>",
+    user_agent=USER_AGENT,
     client_id=os.environ["CCP_CLIENT_ID"],
     client_secret=os.environ["CCP_SECRET_KEY"],
     callback_url=os.environ["CCP_REDIRECT_URI"],
@@ -49,10 +67,10 @@ base_preston = Preston(
 
 # Setup Discord
 intent = discord.Intents.default()
-bot = commands.Bot(command_prefix='!', intents=intent)
+bot = commands.Bot(command_prefix='!', intents=intent, max_ratelimit_timeout=MAX_RATELIMIT_TIMEOUT)
 
 
-async def log_statistics():
+def log_statistics():
     """Log the number of users and their characters on bot startup."""
     try:
         for user in User.select():
@@ -86,16 +104,27 @@ def command_error_handler(func):
     return wrapper
 
 
+async def start_polling():
+    """Start polling ESI, all messages are written to the outbox. With partitioning, the corporations
+    of this replica are planned once partition_pings leased some partitions."""
+    load_schedules(await run_db(load_characters))
+    await run_db(load_notification_index)
+    await load_timers()
+    partition_pings.start()
+    notification_pings.start(base_preston)
+    status_pings.start(base_preston)
+    cleanup_old_notifications.start()
+    timer_pings.start()
+
+
 @bot.event
 async def on_ready():
-    # Setup Lock for actions
-    action_lock = asyncio.Lock()
-
     # Start background tasks
-    notification_pings.start(action_lock, base_preston, bot)
-    status_pings.start(action_lock, base_preston, bot)
-    cleanup_old_notifications.start(action_lock)
+    if ROLE == "all":
+        await start_polling()
+    outbox_pings.start(bot)
     webserver.start(bot, base_preston)
+    metrics_server.start()
 
     logger.info(f"on_ready() logged in as {bot.user} (ID: {bot.user.id})")
     try:
@@ -104,10 +133,29 @@ async def on_ready():
     except Exception as e:
         logger.error(f"on_ready() failed to sync slash commands: {e}", exc_info=True)
 
-    await log_statistics()
+    await run_db(log_statistics)
 
     await asyncio.sleep(60 * 60 * 5)  # Wait 5 hours
-    no_auth_pings.start(action_lock, bot)
+    no_auth_pings.start(bot)
+
+
+def create_challenge(user_id: str, channel_id: str, state: str):
+    """Register a user if needed and replace their pending authorization challenge."""
+    with db.atomic():
+        user, created = User.get_or_create(user_id=user_id, defaults={"callback_channel_id": channel_id})
+        Challenge.delete().where(Challenge.user == user).execute()
+        Challenge.create(user=user, state=state)
+
+
+def revoke_user(user: User) -> list[Character]:
+    """Delete a user with all their characters and pending messages, returns the deleted characters."""
+    with db.atomic():
+        user_characters = list(Character.select().where(Character.user == user))
+        Character.delete().where(Character.user == user).execute()
+        Outbox.delete().where(Outbox.user == user).execute()
+        StructureSubscription.delete().where(StructureSubscription.user == user).execute()
+        user.delete_instance()
+    return user_characters
 
 
 @bot.tree.command(name="auth", description="Sends you an authorization link for characters.")
@@ -115,12 +163,7 @@ async def on_ready():
 async def auth(interaction: Interaction):
     secret_state = secrets.token_urlsafe(60)
 
-    user, created = User.get_or_create(
-        user_id=str(interaction.user.id),
-        defaults={"callback_channel_id": str(interaction.channel.id)},
-    )
-    Challenge.delete().where(Challenge.user == user).execute()
-    Challenge.create(user=user, state=secret_state)
+    await run_db(create_challenge, str(interaction.user.id), str(interaction.channel.id), secret_state)
 
     full_link = base_preston.get_authorize_url(secret_state)
     # noinspection PyUnresolvedReferences
@@ -139,7 +182,7 @@ async def callback(interaction: Interaction, channel: discord.TextChannel | None
 
     Optionally, mention a channel (e.g. #alerts) to set it as the callback.
     """
-    user = User.get_or_none(user_id=str(interaction.user.id))
+    user = await run_db(User.get_or_none, user_id=str(interaction.user.id))
     if user is None:
         # noinspection PyUnresolvedReferences
         await interaction.response.send_message(
@@ -148,8 +191,9 @@ async def callback(interaction: Interaction, channel: discord.TextChannel | None
         return
 
     target_channel = channel or interaction.channel
+    invalidate_channel(user.callback_channel_id)
     user.callback_channel_id = str(target_channel.id)
-    user.save()
+    await run_db(user.save)
 
     if isinstance(target_channel, discord.DMChannel):
         await send_foreground_warning(interaction, await channel_warning(user))
@@ -161,12 +205,12 @@ async def callback(interaction: Interaction, channel: discord.TextChannel | None
 
 
 async def update_channel_if_broken(interaction, bot):
-    user = User.get_or_none(user_id=str(interaction.user.id))
+    user = await run_db(User.get_or_none, user_id=str(interaction.user.id))
     if user is None:
         return
 
     try:
-        await bot.fetch_channel(int(user.callback_channel_id))
+        await resolve_channel(user, bot)
         return
     except (discord.errors.Forbidden, discord.errors.NotFound, discord.errors.HTTPException,
             discord.errors.InvalidData) as e:
@@ -176,9 +220,10 @@ async def update_channel_if_broken(interaction, bot):
             f"update_channel_if_broken() channel broken in a different way than expected for user {user}: {e}",
             exc_info=True)
 
+    invalidate_channel(user.callback_channel_id)
     target_channel = interaction.channel
     user.callback_channel_id = str(target_channel.id)
-    user.save()
+    await run_db(user.save)
 
     await send_foreground_warning(interaction, await updated_channel_warning(user, target_channel))
 
@@ -186,6 +231,22 @@ async def update_channel_if_broken(interaction, bot):
         await send_foreground_warning(interaction, await channel_warning(user))
 
 
+async def is_authorized(interaction: Interaction, character) -> bool:
+    """Returns true if the token of a character still works, otherwise warns the user and returns false."""
+    try:
+        await authenticate_character(base_preston, character)
+    except aiohttp.ClientResponseError as exp:
+        if exp.status == 401:
+            await send_foreground_warning(
+                interaction,
+                await esi_permission_warning(character, base_preston)
+            )
+            return False
+        else:
+            raise
+    return True
+
+
 @bot.tree.command(name="characters", description="Shows all authorized characters")
 @command_error_handler
 async def characters(interaction: Interaction):
@@ -196,23 +257,26 @@ async def characters(interaction: Interaction):
     await update_channel_if_broken(interaction, bot)
 
     character_names = []
-    user = User.get_or_none(User.user_id == str(interaction.user.id))
+    user = await run_db(User.get_or_none, User.user_id == str(interaction.user.id))
     if user:
-        for character in user.characters:
-            try:
-                authed_preston = await base_preston.authenticate_from_token(character.token)
-            except aiohttp.ClientResponseError as exp:
-                if exp.status == 401:
-                    await send_foreground_warning(
-                        interaction,
-                        await esi_permission_warning(character, base_preston)
-                    )
-                    continue
-                else:
-                    raise
-
-            character_data = await authed_preston.whoami()
-            character_names.append(f"- {character_data.get('character_name', 'Unknown')}")
+        user_characters = await run_db(load_user_characters, user)
+        results = await bounded_gather(
+            (is_authorized(interaction, character) for character in user_characters), COMMAND_CONCURRENCY
+        )
+
+        authorized_characters = []
+        for character, result in zip(user_characters, results):
+            if isinstance(result, Exception):
+                logger.error(f"/characters could not check {character}: {result}", exc_info=result)
+            elif result:
+                authorized_characters.append(character)
+
+        # All names are resolved with one bulk call, or from the name cache
+        names = await resolve_names(
+            [(CHARACTER, character.character_id) for character in authorized_characters], base_preston
+        )
+        for character in authorized_characters:
+            character_names.append(f"- {names.get((CHARACTER, str(character.character_id)), 'Unknown')}")
 
     if not character_names:
         await interaction.followup.send("You have no authorized characters!", ephemeral=True)
@@ -240,21 +304,19 @@ async def characters(interaction: Interaction):
 async def revoke(interaction: Interaction, character_name: str | None = None):
     # noinspection PyUnresolvedReferences
     await interaction.response.defer(ephemeral=True)
-    user = User.get_or_none(User.user_id == str(interaction.user.id))
+    user = await run_db(User.get_or_none, User.user_id == str(interaction.user.id))
 
     if not user:
         await interaction.followup.send(
             f"You did not have any authorized characters in the first place.",
             ephemeral=True
         )
+        return
 
     if character_name is None:
-        user_characters = Character.select().where(Character.user == user)
-        if user_characters:
-            for character in user_characters:
-                character.delete_instance()
-
-        user.delete_instance()
+        for character in await run_db(revoke_user, user):
+            forget_character(character.character_id)
+            character_removed(character)
 
         await interaction.followup.send(f"Successfully revoked access to all your characters.", ephemeral=True)
         return
@@ -263,10 +325,12 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
         character_id = int(character_name)
     except ValueError:
         try:
-            result = await base_preston.post_op(
+            result = await esi_call(
+                base_preston.post_op,
                 'post_universe_ids',
                 path_data={},
-                post_data=[character_name]
+                post_data=[character_name],
+                critical=False,
             )
             character_id = int(max(result.get("characters"), key=lambda x: x.get("id")).get("id"))
         except (ValueError, KeyError):
@@ -276,9 +340,12 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
             )
             return
 
-    character = user.characters.select().where(Character.character_id == character_id).first()
+    character = await run_db(user.characters.select().where(Character.character_id == character_id).first)
     if character:
-        character.delete_instance()
+        forget_character(character.character_id)
+        character_removed(character)
+        await run_db(character.delete_instance)
+        await run_db(remove_structure_subscriptions, character.corporation_id, user.user_id)
         await interaction.followup.send(f"Successfully removed {character_name}.", ephemeral=True)
     else:
         await interaction.followup.send(
@@ -287,51 +354,89 @@ async def revoke(interaction: Interaction, character_name: str | None = None):
         )
 
 
+async def fetch_corporation_structures(interaction: Interaction, corporation_id: str, corporation_characters):
+    """Fetch the structures of a corporation from ESI with the first of its characters that is able to,
+    store them as the snapshot of the corporation and returns them, or None if no character could fetch them.
+    Whether each tried character could fetch them is remembered, which decides if /info may show the snapshot."""
+    for character in corporation_characters:
+        try:
+            authed_preston = await authenticate_character(base_preston, character)
+        except aiohttp.ClientResponseError as exp:
+            if exp.status == 401:
+                await send_foreground_warning(interaction, await esi_permission_warning(character, base_preston))
+                continue
+            else:
+                raise
+
+        try:
+            structure_response = await esi_call(
+                authed_preston.get_op,
+                "get_corporations_corporation_id_structures",
+                corporation_id=corporation_id,
+            )
+        except aiohttp.ClientResponseError as exp:
+            await handle_structure_error(character, authed_preston, exp, interaction=interaction)
+            continue
+
+        await record_structure_access(character, True)
+        await run_db(store_structure_snapshot, corporation_id, structure_response)
+        return structure_response
+    return None
+
+
 @bot.tree.command(
     name="info",
     description="Returns the status of all structures linked."
 )
+@app_commands.describe(
+    refresh="Fetch the structures from ESI right now instead of showing the state of the last poll."
+)
 @command_error_handler
-async def info(interaction: Interaction):
+async def info(interaction: Interaction, refresh: bool = False):
     # noinspection PyUnresolvedReferences
     await interaction.response.defer()
 
     await update_channel_if_broken(interaction, bot)
 
     structures_info = {}
+    fetched_at = []
 
-    user = User.get_or_none(User.user_id == str(interaction.user.id))
+    user = await run_db(User.get_or_none, User.user_id == str(interaction.user.id))
     if user:
-        for character in user.characters:
-            try:
-                authed_preston = await base_preston.authenticate_from_token(character.token)
-            except aiohttp.ClientResponseError as exp:
-                if exp.status == 401:
-                    await send_foreground_warning(interaction, await esi_permission_warning(character, base_preston))
-                    continue
-                else:
-                    raise
-
-            try:
-                structure_response = await authed_preston.get_op(
-                    "get_corporations_corporation_id_structures",
-                    corporation_id=character.corporation_id,
-                )
-            except ConnectionError:
-                logger.warning(f"/info got a network error got {character}")
+        corporations = {}
+        for character in await run_db(load_user_characters, user):
+            corporations.setdefault(str(character.corporation_id), []).append(character)
+
+        # Snapshots are only shown for corporations in which a character of the user could fetch the structures
+        verified = [
+            corporation_id for corporation_id, characters in corporations.items()
+            if any(character.structure_access for character in characters)
+        ]
+        snapshots = {} if refresh else await run_db(load_structure_snapshots, verified)
+        missing = [corporation_id for corporation_id in corporations if corporation_id not in snapshots]
+
+        # Corporations without a snapshot or without a verified character are fetched right away, each of them once
+        results = await bounded_gather(
+            (fetch_corporation_structures(interaction, corporation_id, corporations[corporation_id])
+             for corporation_id in missing),
+            COMMAND_CONCURRENCY,
+        )
+        for corporation_id, result in zip(missing, results):
+            if isinstance(result, ConnectionError):
+                logger.warning(f"/info got a network error for corporation {corporation_id}")
                 await interaction.followup.send("Network error with /info command, try again later")
-                return
-            except aiohttp.ClientResponseError as exp:
-                await handle_structure_error(character, authed_preston, exp, interaction=interaction)
-                return
-            except Exception as e:
-                await interaction.followup.send(f"Got an unfamiliar error in /info command: {e}.")
-                logger.error(f"/info got an unfamiliar error with {character}: {e}.", exc_info=True)
-                return
-            else:
-                for structure in structure_response:
-                    structure_id = structure.get("structure_id")
-                    structures_info[structure_id] = structure_info_text(structure)
+            elif isinstance(result, Exception):
+                await interaction.followup.send(f"Got an unfamiliar error in /info command: {result}.")
+                logger.error(f"/info got an unfamiliar error for corporation {corporation_id}: {result}.",
+                             exc_info=result)
+            elif result is not None:
+                snapshots[corporation_id] = (result, datetime.now(UTC))
+
+        for structures, snapshot_time in snapshots.values():
+            fetched_at.append(snapshot_time)
+            for structure in structures:
+                structure_id = structure.get("structure_id")
+                structures_info[structure_id] = structure_info_text(structure)
 
     if not structures_info:
         await interaction.followup.send("No structures found!\n")
@@ -341,6 +446,12 @@ async def info(interaction: Interaction):
         chunk = structures_list[i:i + 10]
         await interaction.followup.send("\n" + "".join(chunk))
 
+    if structures_info and fetched_at:
+        oldest = int(min(fetched_at).timestamp())
+        await interaction.followup.send(
+            f"Structures as of <t:{oldest}:R>, use `/info refresh:True` to fetch them from ESI right now."
+        )
+
 
 @bot.tree.command(
     name="action",
@@ -360,15 +471,22 @@ async def action(interaction: Interaction, text: str):
     # noinspection PyUnresolvedReferences
     await interaction.response.send_message("Sending action text...")
 
+    # Messages are queued per channel, so all users are sent to concurrently
+    users = await run_db(list, User.select())
+    results = await bounded_gather(
+        (send_background_message(bot, user, text) for user in users), DELIVERY_CONCURRENCY
+    )
+
     used_channels = set()
     user_count = 0
-    for user in User.select():
-        try:
-            if await send_background_message(bot, user, text):
-                used_channels.add(user.callback_channel_id)
-        except discord.errors.Forbidden:
+    for user, result in zip(users, results):
+        if isinstance(result, discord.errors.Forbidden):
             await interaction.followup.send(f"Could not reach user {user}.")
             logger.info(f"/action could not reach user {user}.")
+        elif isinstance(result, Exception):
+            logger.error(f"/action could not send to user {user}: {result}", exc_info=result)
+        elif result:
+            used_channels.add(user.callback_channel_id)
         user_count += 1
 
     await interaction.followup.send(f"Sent action text to {user_count} users. The message looks like the following:")
@@ -392,22 +510,24 @@ async def debug(interaction: Interaction, character_id: int):
     # noinspection PyUnresolvedReferences
     await interaction.response.defer(ephemeral=True)
 
-    character = Character.get_or_none(Character.character_id == character_id)
+    character = await run_db(Character.get_or_none, Character.character_id == character_id)
     if not character:
         await interaction.followup.send("Character not found in the database.", ephemeral=True)
         return
 
     try:
-        authed_preston = await base_preston.authenticate_from_token(character.token)
-        character_data = await authed_preston.whoami()
+        authed_preston = await authenticate_character(base_preston, character)
+        character_data = await character_from_token(authed_preston)
         character_name = character_data.get("character_name", "Unknown")
 
-        structure_response = await authed_preston.get_op(
+        structure_response = await esi_call(
+            authed_preston.get_op,
             "get_corporations_corporation_id_structures",
             corporation_id=character.corporation_id,
         )
 
-        notification_response = await authed_preston.get_op(
+        notification_response = await esi_call(
+            authed_preston.get_op,
             "get_characters_character_id_notifications",
             character_id=character.character_id
         )
@@ -435,7 +555,7 @@ async def debug(interaction: Interaction, character_id: int):
 )
 @command_error_handler
 async def dryrun(interaction: Interaction):
-    user = User.get_or_none(user_id=interaction.user.id)
+    user = await run_db(User.get_or_none, user_id=interaction.user.id)
 
     if user is not None:
         success = await send_background_message(
@@ -460,5 +580,34 @@ async def dryrun(interaction: Interaction):
         )
 
 
+async def run_poller():
+    """Poll ESI and write all messages to the outbox, without connecting to discord at all."""
+    await start_polling()
+    metrics_server.start()
+    logger.info("run_poller() started polling.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await run_db(release_partitions)
+
+
+async def run_sender():
+    """Deliver the outbox through the discord REST API, without connecting to the gateway."""
+    async with bot:
+        await bot.login(os.environ["DISCORD_TOKEN"])
+        outbox_pings.start(bot)
+        metrics_server.start()
+        logger.info(f"run_sender() logged in as {bot.user} (ID: {bot.user.id})")
+        await asyncio.Event().wait()
+
+
 if __name__ == "__main__":
-    bot.run(os.environ["DISCORD_TOKEN"])
+    match ROLE:
+        case "all" | "gateway":
+            bot.run(os.environ["DISCORD_TOKEN"])
+        case "poller":
+            asyncio.run(run_poller())
+        case "sender":
+            asyncio.run(run_sender())
+        case _:
+            raise SystemExit(f"Unknown ROLE {ROLE}, use one of all, gateway, poller or sender.")
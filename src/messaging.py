@@ -1,36 +1,176 @@
+import asyncio
 import discord
+import heapq
 import logging
-from collections import defaultdict
+import os
+from dataclasses import dataclass, field
+from enum import IntEnum
+from itertools import count
+from peewee import chunked
+from time import monotonic
+
+from database import run_db
+from models import Outbox, User
 
 logger = logging.getLogger('discord.timer.utils')
 
-user_disconnected_count = defaultdict(int)
+# Seconds a resolved callback channel is reused before it is looked up again
+CHANNEL_CACHE_TIME = 15 * 60
+
+# Messages queued for the same channel within this many seconds are sent as one message
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0.5"))
+MESSAGE_LIMIT = 2000
+
+# Seconds after which the worker of an unused channel queue shuts down
+CHANNEL_IDLE_TIME = 10 * 60
+
+# Maximum number of messages being sent at the same time across all channels
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "10"))
+
+# Channel rate limits longer than this many seconds are not waited out by discord.py but raise RateLimited,
+# so that the delivery slot is freed and the channel retries in order of priority. discord.py requires at least 30
+MAX_RATELIMIT_TIMEOUT = float(os.getenv("MAX_RATELIMIT_TIMEOUT", "30"))
+
+resolved_channels = {}
+channel_queues = {}
+channel_workers = {}
+
+
+class Priority(IntEnum):
+    """Delivery classes, lower values are delivered first."""
+    COMBAT = 0
+    STATUS = 1
+    HOUSEKEEPING = 2
+
+
+@dataclass(order=True)
+class QueuedMessage:
+    priority: Priority
+    sequence: int
+    user: object = field(compare=False)
+    text: str = field(compare=False)
+    identifier: str = field(compare=False)
+    quiet: bool = field(compare=False)
+    result: asyncio.Future = field(compare=False)
+    queued_at: float = field(compare=False, default_factory=monotonic)
+
+
+class DeliveryGate:
+    """Limits how many messages are sent at the same time across all channels,
+    handing free slots to waiting messages in order of priority."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.sequence = count()
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class DeliveryStatistics:
+    """Queue depth and wait time of one priority class."""
+
+    def __init__(self):
+        self.queued = 0
+        self.delivered = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.queued -= 1
+        self.delivered += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        return {
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "average_wait": self.total_wait / self.delivered if self.delivered else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+def invalidate_channel(channel_id):
+    """Forget a resolved channel, e.g. after sending to it failed or a user picked a different one."""
+    resolved_channels.pop(str(channel_id), None)
+
+
+async def resolve_channel(user, bot):
+    """Resolve the callback channel of a user, preferring the gateway cache over a REST call."""
+    channel_id = str(user.callback_channel_id)
+
+    cached = resolved_channels.get(channel_id)
+    if cached is not None and cached[1] > monotonic():
+        return cached[0]
+
+    channel = bot.get_channel(int(channel_id))
+    if channel is None:
+        channel = await bot.fetch_channel(int(channel_id))
+
+    resolved_channels[channel_id] = (channel, monotonic() + CHANNEL_CACHE_TIME)
+    return channel
 
 
 async def get_channel(user, bot):
     """Get a discord channel for a specific user."""
     emergency_dm = False
     try:
-        channel = await bot.fetch_channel(int(user.callback_channel_id))
+        channel = await resolve_channel(user, bot)
     except (discord.errors.Forbidden, discord.errors.NotFound, discord.errors.HTTPException,
             discord.errors.InvalidData):
+        invalidate_channel(user.callback_channel_id)
         try:
             discord_user = await bot.fetch_user(int(user.user_id))
             channel = await discord_user.create_dm()
             emergency_dm = True
         except Exception as e:
             logger.warning(f"Failed to get channel or open DM channel for user {user}: {e}", exc_info=True)
-            return None
+            return None, False
 
     except Exception as e:
         logger.warning(f"Failed to get channel for user {user}: {e}", exc_info=True)
-        return None
+        return None, False
 
     return channel, emergency_dm
 
 
-async def send_background_message(bot, user, message, identifier="<no identifier>", quiet=False):
-    """Wrapper to send a message to a user, automatically handles not being able to reach user and fallback options.
+async def record_reachability(user, reached: bool):
+    """Count failed deliveries to a user in a row, stored so that replicas sharing the database see the same count."""
+    if reached:
+        if user.disconnected_count:
+            user.disconnected_count = 0
+            await run_db(User.update(disconnected_count=0).where(User.user_id == user.user_id).execute)
+    else:
+        user.disconnected_count += 1
+        await run_db(User.update(disconnected_count=User.disconnected_count + 1).where(
+            User.user_id == user.user_id
+        ).execute)
+
+
+async def deliver_message(bot, user, message, identifier="<no identifier>", quiet=False):
+    """Send a message to a user right away, automatically handles not being able to reach user and fallback options.
     Returns true if successful
     """
 
@@ -43,7 +183,7 @@ async def send_background_message(bot, user, message, identifier="<no identifier
                 f"Recipient Identifier: {identifier}\n"
                 f"Message: {message}"
             )
-        user_disconnected_count[user] += 1
+        await record_reachability(user, False)
         return False
 
     try:
@@ -56,25 +196,156 @@ async def send_background_message(bot, user, message, identifier="<no identifier
             )
         await user_channel.send(message)
 
+    except discord.errors.RateLimited:
+        # The channel is not at fault, the caller retries once the rate limit is over
+        raise
     except (discord.errors.Forbidden, discord.errors.NotFound, discord.errors.HTTPException,
             discord.errors.InvalidData):
+        invalidate_channel(user.callback_channel_id)
         if not quiet:
             logger.info(
                 f"Sending message to {user} failed (discord permissions).\n"
                 f"Recipient Identifier: {identifier}\n"
                 f"Message: {message}"
             )
-        user_disconnected_count[user] += 1
+        await record_reachability(user, False)
         return False
     except Exception as e:
+        invalidate_channel(user.callback_channel_id)
         if not quiet:
             logger.warning(
                 f"Sending message to {user} failed (unknown exception).\n"
                 f"Recipient Identifier: {identifier}\n"
                 f"Message: {message}", exc_info=True
             )
-        user_disconnected_count[user] += 1
+        await record_reachability(user, False)
         return False
     else:
-        user_disconnected_count[user] = 0
+        await record_reachability(user, True)
         return True
+
+
+delivery_gate = DeliveryGate(DELIVERY_CONCURRENCY)
+delivery_statistics = {priority: DeliveryStatistics() for priority in Priority}
+message_sequence = count()
+
+
+def get_delivery_statistics():
+    """Returns queue depth and wait times of each priority class."""
+    return {priority.name.lower(): statistics.as_dict() for priority, statistics in delivery_statistics.items()}
+
+
+def next_batch(messages):
+    """Take the leading messages which have the same priority, go to the same user and fit into one message."""
+    batch = [messages[0]]
+    length = len(messages[0].text)
+    for message in messages[1:]:
+        length += len(message.text) + 1
+        if (message.priority != batch[0].priority or message.user.user_id != batch[0].user.user_id
+                or length > MESSAGE_LIMIT):
+            break
+        batch.append(message)
+    return batch
+
+
+async def deliver_channel(bot, channel_id):
+    """Deliver everything queued for one channel in order of priority,
+    sending messages queued close together as one message."""
+    queue = channel_queues[channel_id]
+    while True:
+        try:
+            first = await asyncio.wait_for(queue.get(), timeout=CHANNEL_IDLE_TIME)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                del channel_queues[channel_id]
+                del channel_workers[channel_id]
+                return
+            continue
+
+        pending = [first]
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+
+        # A burst is arriving, wait until its oldest message was queued for COALESCE_WINDOW to merge whatever follows.
+        # Lone messages, combat alerts and messages left over from the previous batch go right away
+        wait = COALESCE_WINDOW - (monotonic() - min(m.queued_at for m in pending))
+        if len(pending) > 1 and wait > 0 and all(m.priority != Priority.COMBAT for m in pending):
+            await asyncio.sleep(wait)
+            while not queue.empty():
+                pending.append(queue.get_nowait())
+        pending.sort()
+
+        batch = next_batch(pending)
+        for message in pending[len(batch):]:
+            queue.put_nowait(message)
+
+        retry_after = None
+        await delivery_gate.acquire(batch[0].priority)
+        try:
+            success = await deliver_message(
+                bot,
+                batch[0].user,
+                "\n".join(m.text for m in batch),
+                ", ".join(m.identifier for m in batch),
+                quiet=all(m.quiet for m in batch),
+            )
+        except discord.errors.RateLimited as e:
+            retry_after = e.retry_after
+        except Exception as e:
+            logger.error(f"Delivering messages to channel {channel_id} failed: {e}", exc_info=True)
+            success = False
+        finally:
+            delivery_gate.release()
+
+        if retry_after is not None:
+            # Other channels use the delivery slot meanwhile, the batch is merged again with whatever was queued
+            # during the wait, so that e.g. combat alerts which arrived meanwhile go first
+            logger.info(f"Delivering messages to channel {channel_id} is rate limited, retrying in {retry_after:.1f}s.")
+            for m in batch:
+                queue.put_nowait(m)
+            await asyncio.sleep(retry_after)
+            continue
+
+        for m in batch:
+            delivery_statistics[m.priority].record(monotonic() - m.queued_at)
+            if not m.result.done():
+                m.result.set_result(success)
+
+
+async def send_background_message(bot, user, message, identifier="<no identifier>", quiet=False,
+                                  priority=Priority.HOUSEKEEPING):
+    """Wrapper to send a message to a user, automatically handles not being able to reach user and fallback options.
+    Messages are queued per channel in order of priority and bursts are merged,
+    so this only returns once the message was delivered.
+    Returns true if successful
+    """
+    channel_id = str(user.callback_channel_id)
+    if channel_id not in channel_queues:
+        channel_queues[channel_id] = asyncio.PriorityQueue()
+        channel_workers[channel_id] = asyncio.create_task(deliver_channel(bot, channel_id))
+
+    result = asyncio.get_running_loop().create_future()
+    delivery_statistics[priority].queued += 1
+    channel_queues[channel_id].put_nowait(
+        QueuedMessage(priority, next(message_sequence), user, message, identifier, quiet, result)
+    )
+    return await result
+
+
+def outbox_entry(user, message, identifier="<no identifier>", priority=Priority.HOUSEKEEPING) -> dict:
+    """Build an outbox row for a message, to be written in the same transaction as the change that caused it."""
+    return {"user": user.user_id, "message": message, "identifier": identifier, "priority": int(priority)}
+
+
+def one_per_channel(users) -> list:
+    """Keep only the first of several users sharing a callback channel, so that a message for all of them is sent once."""
+    channels = {}
+    for user in users:
+        channels.setdefault(str(user.callback_channel_id), user)
+    return list(channels.values())
+
+
+def write_outbox(entries):
+    """Store outbox rows with as few statements as possible, they are sent later by the outbox loop."""
+    for batch in chunked(entries, 100):
+        Outbox.insert_many(batch).execute()
@@ -1,6 +1,7 @@
 import os
 from datetime import datetime, UTC
 from peewee import *
+from playhouse.migrate import SchemaMigrator, migrate
 from playhouse.pool import PooledPostgresqlDatabase
 
 
@@ -34,6 +35,11 @@ def get_database():
 db = get_database()
 
 
+def as_utc(timestamp: datetime) -> datetime:
+    """Returns a stored timestamp as UTC, databases without time zone support return naive UTC timestamps."""
+    return timestamp.replace(tzinfo=timestamp.tzinfo or UTC)
+
+
 class BaseModel(Model):
     class Meta:
         database = db
@@ -42,6 +48,7 @@ class BaseModel(Model):
 class User(BaseModel):
     user_id = CharField(primary_key=True)
     callback_channel_id = CharField()
+    disconnected_count = IntegerField(default=0)
 
     def __repr__(self):
         return f"User(user_id={self.user_id}, callback_channel_id={self.callback_channel_id})"
@@ -55,6 +62,17 @@ class Character(BaseModel):
     corporation_id = CharField()
     user = ForeignKeyField(User, backref='characters')
     token = TextField()
+    # Failure state of notification polls, structure polls back off on their own
+    failure_count = IntegerField(default=0)
+    backoff_until = DateTimeField(null=True)
+    structure_failure_count = IntegerField(default=0)
+    structure_backoff_until = DateTimeField(null=True)
+    disconnected_count = IntegerField(default=0)
+    disconnected_since = DateTimeField(null=True)
+    # Whether the character could fetch the structures of its corporation, None until it tried
+    structure_access = BooleanField(null=True)
+    # Set whenever a character is added or moves to another corporation, pollers pick up changes after it
+    updated_at = DateTimeField(default=lambda: datetime.now(UTC))
 
     def __repr__(self):
         return f"Character(character_id={self.character_id}, corporation_id{self.corporation_id}, user_id={self.user.user_id}, token={self.token})"
@@ -83,11 +101,132 @@ class Structure(BaseModel):
     last_fuel_warning = IntegerField()
 
 
+class StructureSnapshot(BaseModel):
+    corporation_id = CharField(primary_key=True)
+    payload = TextField()
+    fetched_at = DateTimeField(default=lambda: datetime.now(UTC))
+
+
+class Name(BaseModel):
+    category = CharField()
+    entity_id = CharField()
+    name = CharField()
+    fetched_at = DateTimeField(default=lambda: datetime.now(UTC))
+
+    class Meta:
+        primary_key = CompositeKey('category', 'entity_id')
+
+
+class Timer(BaseModel):
+    structure = ForeignKeyField(Structure, backref='timers', on_delete='CASCADE')
+    kind = CharField()
+    level = IntegerField()
+    fire_at = DateTimeField(index=True)
+    snapshot = TextField()
+
+    class Meta:
+        indexes = ((('structure', 'kind', 'level'), True),)
+
+    def __str__(self):
+        return f"Timer(structure={self.structure_id}, kind={self.kind}, level={self.level}, fire_at={self.fire_at})"
+
+
+class Outbox(BaseModel):
+    user = ForeignKeyField(User, backref='outbox')
+    message = TextField()
+    identifier = CharField(default="<no identifier>")
+    priority = IntegerField(default=2)
+    created_at = DateTimeField(default=lambda: datetime.now(UTC))
+    next_attempt_at = DateTimeField(default=lambda: datetime.now(UTC), index=True)
+    attempts = IntegerField(default=0)
+    claimed_by = CharField(null=True)
+    claimed_until = DateTimeField(null=True)
+
+    def __str__(self):
+        return f"Outbox(id={self.id}, user={self.user_id}, attempts={self.attempts})"
+
+
+class StructureSubscription(BaseModel):
+    structure = ForeignKeyField(Structure, backref='subscriptions', on_delete='CASCADE')
+    user = ForeignKeyField(User, backref='structure_subscriptions', on_delete='CASCADE')
+    last_state = CharField()
+    last_fuel_warning = IntegerField()
+
+    class Meta:
+        indexes = ((('structure', 'user'), True),)
+
+
+class SentWarning(BaseModel):
+    log_text = CharField(primary_key=True)
+    next_at = DateTimeField()
+
+
+class Worker(BaseModel):
+    worker_id = CharField(primary_key=True)
+    heartbeat_at = DateTimeField(index=True)
+
+
+class Lease(BaseModel):
+    partition = IntegerField(primary_key=True)
+    owner = CharField(null=True)
+    expires_at = DateTimeField(default=lambda: datetime.now(UTC))
+
+
 class Migration(BaseModel):
     name = CharField(unique=True)
     applied_at = DateTimeField(default=lambda: datetime.now(UTC))
 
 
+def add_missing_columns(migrator, model, *fields):
+    """Add columns of a model which were introduced after its table was created."""
+    existing = {column.name for column in db.get_columns(model._meta.table_name)}
+    migrate(*[
+        migrator.add_column(model._meta.table_name, field.column_name, field)
+        for field in fields if field.column_name not in existing
+    ])
+
+
+# Schema changes of existing tables, applied once each and in order
+migrations = [
+    ("0001_character_backoff", lambda migrator: add_missing_columns(
+        migrator, Character, Character.failure_count, Character.backoff_until
+    )),
+    ("0002_shared_worker_state", lambda migrator: (
+        add_missing_columns(migrator, User, User.disconnected_count),
+        add_missing_columns(migrator, Character, Character.disconnected_count),
+        add_missing_columns(migrator, Outbox, Outbox.claimed_by, Outbox.claimed_until),
+    )),
+    ("0003_structure_backoff", lambda migrator: add_missing_columns(
+        migrator, Character, Character.structure_failure_count, Character.structure_backoff_until
+    )),
+    # The index is created here, create_tables would try to create it before the column exists
+    ("0004_character_updated_at", lambda migrator: (
+        add_missing_columns(migrator, Character, Character.updated_at),
+        migrate(migrator.add_index(Character._meta.table_name, (Character.updated_at.column_name,))),
+    )),
+    # Existing characters stay unverified and keep receiving structure messages until a structure poll, which tries them
+    # first, records whether they have access
+    ("0005_structure_access", lambda migrator: add_missing_columns(
+        migrator, Character, Character.structure_access
+    )),
+    ("0006_character_disconnected_since", lambda migrator: add_missing_columns(
+        migrator, Character, Character.disconnected_since
+    )),
+]
+
+
+def apply_migrations():
+    applied = {migration.name for migration in Migration.select()}
+    migrator = SchemaMigrator.from_database(db)
+    for name, apply in migrations:
+        if name not in applied:
+            with db.atomic():
+                apply(migrator)
+                Migration.create(name=name)
+
+
 def initialize_database():
     with db:
-        db.create_tables([User, Character, Challenge, Notification, Structure, Migration])
+        db.create_tables([User, Character, Challenge, Notification, Structure, StructureSubscription, Timer, Outbox, Name,
+                          SentWarning, Worker, Lease, StructureSnapshot, Migration])
+        apply_migrations()
@@ -0,0 +1,171 @@
+import aiohttp
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from preston import Preston
+
+from concurrency import bounded_gather
+from database import run_db
+from esi_client import esi_call, single_flight
+from models import Name, as_utc, db
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.names')
+
+CHARACTER = "character"
+STRUCTURE = "structure"
+PLANET = "planet"
+
+# How long a resolved name is trusted, None for names which never change
+name_cache_times = {
+    CHARACTER: timedelta(days=7),
+    STRUCTURE: timedelta(days=1),
+    PLANET: None,
+}
+
+# Number of names kept in memory in front of the database
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", "10000"))
+
+# Structures and planets have no bulk endpoint, at most this many of them are looked up at once
+NAME_LOOKUP_CONCURRENCY = 5
+
+# post_universe_names accepts at most this many ids per call
+NAMES_PER_REQUEST = 1000
+
+recent_names = OrderedDict()
+name_statistics = {"memory_hits": 0, "database_hits": 0, "lookups": 0, "failures": 0}
+
+
+def is_fresh(category: str, fetched_at: datetime) -> bool:
+    cache_time = name_cache_times[category]
+    if cache_time is None:
+        return True
+    return as_utc(fetched_at) + cache_time > datetime.now(timezone.utc)
+
+
+def remember(key: tuple[str, str], name: str, fetched_at: datetime):
+    """Keep a name in the in-memory LRU, evicting the least recently used names."""
+    recent_names[key] = (name, fetched_at)
+    recent_names.move_to_end(key)
+    while len(recent_names) > NAME_CACHE_SIZE:
+        recent_names.popitem(last=False)
+
+
+def stored_names(keys: set[tuple[str, str]]) -> list[Name]:
+    return list(Name.select().where(Name.entity_id.in_([entity_id for _, entity_id in keys])))
+
+
+def store_names(names: dict, fetched_at: datetime):
+    with db.atomic():
+        Name.insert_many([
+            {"category": category, "entity_id": entity_id, "name": name, "fetched_at": fetched_at}
+            for (category, entity_id), name in names.items()
+        ]).on_conflict(
+            conflict_target=[Name.category, Name.entity_id],
+            preserve=[Name.name, Name.fetched_at],
+        ).execute()
+
+
+async def cached_names(keys: set[tuple[str, str]]) -> dict:
+    """Returns the fresh names of keys known in memory or in the database."""
+    names = {}
+    for key in keys:
+        if key in recent_names:
+            name, fetched_at = recent_names[key]
+            if is_fresh(key[0], fetched_at):
+                recent_names.move_to_end(key)
+                names[key] = name
+                name_statistics["memory_hits"] += 1
+
+    missing = keys - names.keys()
+    if missing:
+        for row in await run_db(stored_names, missing):
+            key = (row.category, row.entity_id)
+            if key in missing and is_fresh(row.category, row.fetched_at):
+                remember(key, row.name, row.fetched_at)
+                names[key] = row.name
+                name_statistics["database_hits"] += 1
+    return names
+
+
+async def lookup_characters(character_ids: list[str], preston: Preston) -> dict:
+    names = {}
+    for i in range(0, len(character_ids), NAMES_PER_REQUEST):
+        chunk = character_ids[i:i + NAMES_PER_REQUEST]
+        try:
+            results = await single_flight(
+                ("post_universe_names", tuple(chunk)),
+                esi_call,
+                preston.post_op,
+                'post_universe_names',
+                path_data={},
+                post_data=[int(character_id) for character_id in chunk],
+                critical=False,
+            )
+        except aiohttp.ClientError as e:
+            logger.warning(f"lookup_characters() could not resolve {len(character_ids)} characters: {e}")
+            continue
+        for result in results:
+            names[(CHARACTER, str(result.get("id")))] = result.get("name")
+    return names
+
+
+async def lookup_single(key: tuple[str, str], authed_preston: Preston, requester=None) -> str | None:
+    """Look up the name of a structure or planet, sharing the request with concurrent polls.
+    Structures are looked up with the first character asking, if it has no docking access
+    the refused lookup is only cached for that requester, so other characters still resolve the name."""
+    category, entity_id = key
+    if category == STRUCTURE:
+        result = await single_flight(
+            ("get_universe_structures_structure_id", entity_id),
+            esi_call, authed_preston.get_op, "get_universe_structures_structure_id",
+            failure_key=("get_universe_structures_structure_id", entity_id, requester),
+            structure_id=entity_id, critical=False,
+        )
+    else:
+        result = await single_flight(
+            ("get_universe_planets_planet_id", entity_id),
+            esi_call, authed_preston.get_op, "get_universe_planets_planet_id",
+            planet_id=entity_id, critical=False,
+        )
+    return result.get("name")
+
+
+async def resolve_names(keys, authed_preston: Preston, requester=None) -> dict:
+    """Resolve (category, id) pairs to names, using the in-memory and database caches first.
+    Characters are looked up with one bulk call, structures and planets in parallel, since ESI has no bulk
+    endpoint for them. Keys which could not be resolved are missing from the result.
+    The requester identifies the character authed_preston belongs to, for structures it may not see."""
+    keys = {(category, str(entity_id)) for category, entity_id in keys if entity_id is not None}
+    names = await cached_names(keys)
+
+    missing = sorted(keys - names.keys())
+    if not missing:
+        return names
+
+    resolved = await lookup_characters([entity_id for category, entity_id in missing if category == CHARACTER],
+                                       authed_preston)
+    singles = [key for key in missing if key[0] != CHARACTER]
+    for key, result in zip(singles, await bounded_gather(
+            (lookup_single(key, authed_preston, requester) for key in singles), NAME_LOOKUP_CONCURRENCY
+    )):
+        if isinstance(result, Exception) or result is None:
+            logger.debug(f"resolve_names() could not resolve {key}: {result}")
+            continue
+        resolved[key] = result
+
+    name_statistics["lookups"] += len(missing)
+    name_statistics["failures"] += len(missing) - len(resolved)
+
+    if resolved:
+        fetched_at = datetime.now(timezone.utc)
+        await run_db(store_names, resolved, fetched_at)
+        for key, name in resolved.items():
+            remember(key, name, fetched_at)
+
+    return {**names, **resolved}
+
+
+def get_name_statistics():
+    return {**name_statistics, "in_memory": len(recent_names)}
@@ -0,0 +1,106 @@
+import logging
+import math
+import os
+import socket
+import zlib
+from datetime import datetime, timedelta, UTC
+
+from models import Lease, Worker
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.partitions')
+
+# Replicas sharing one database split the corporations between them, each polling only the partitions it leases
+PARTITIONED = os.getenv("PARTITIONED", "false").lower() == "true"
+
+# Number of partitions corporations are hashed into, must be the same for all replicas
+PARTITIONS = 64
+
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Seconds a lease is valid without being renewed, partitions of a replica which died move on after this time
+LEASE_TIME = int(os.getenv("LEASE_TIME", "45"))
+HEARTBEAT_INTERVAL = LEASE_TIME // 3
+
+owned_partitions = set()
+
+
+def partition_of(corporation_id) -> int:
+    """Returns the partition of a corporation, the same on every replica and across restarts."""
+    return zlib.crc32(str(corporation_id).encode()) % PARTITIONS
+
+
+def owns(corporation_id) -> bool:
+    """Returns true if this replica polls the corporation, which is always the case without partitioning."""
+    return not PARTITIONED or partition_of(corporation_id) in owned_partitions
+
+
+def claim_partitions() -> set[int]:
+    """Renew the leases of this replica and take free or expired ones up to its fair share of the partitions.
+    Partitions above the fair share are given back, so that new replicas get some of them on their next claim.
+    Each lease changes with one conditional update, so two replicas never take the same partition."""
+    now = datetime.now(UTC)
+    expires_at = now + timedelta(seconds=LEASE_TIME)
+
+    Worker.insert(worker_id=WORKER_ID, heartbeat_at=now).on_conflict(
+        conflict_target=[Worker.worker_id],
+        preserve=[Worker.heartbeat_at],
+    ).execute()
+    Worker.delete().where(Worker.heartbeat_at < now - timedelta(seconds=LEASE_TIME)).execute()
+    share = math.ceil(PARTITIONS / max(1, Worker.select().count()))
+
+    Lease.insert_many([
+        {"partition": partition, "expires_at": now} for partition in range(PARTITIONS)
+    ]).on_conflict_ignore().execute()
+
+    owned = [lease.partition for lease in Lease.select(Lease.partition).where(
+        (Lease.owner == WORKER_ID) & (Lease.expires_at >= now)
+    ).order_by(Lease.partition)]
+
+    if released := owned[share:]:
+        Lease.update(owner=None, expires_at=now).where(
+            Lease.partition.in_(released) & (Lease.owner == WORKER_ID)
+        ).execute()
+
+    claimed = set()
+    if kept := owned[:share]:
+        Lease.update(expires_at=expires_at).where(Lease.partition.in_(kept) & (Lease.owner == WORKER_ID)).execute()
+        claimed.update(kept)
+
+    is_free = Lease.owner.is_null() | (Lease.expires_at < now)
+    free = [lease.partition for lease in Lease.select(Lease.partition).where(is_free).order_by(Lease.partition)]
+    for partition in free:
+        if len(claimed) >= share:
+            break
+        if Lease.update(owner=WORKER_ID, expires_at=expires_at).where((Lease.partition == partition) & is_free).execute():
+            claimed.add(partition)
+
+    return claimed
+
+
+def release_partitions():
+    """Give back all leases of this replica and stop counting it, e.g. when it shuts down."""
+    Lease.update(owner=None, expires_at=datetime.now(UTC)).where(Lease.owner == WORKER_ID).execute()
+    Worker.delete().where(Worker.worker_id == WORKER_ID).execute()
+
+
+def update_owned_partitions(claimed: set[int]) -> tuple[set[int], set[int]]:
+    """Remember the partitions of this replica, returns the partitions it gained and lost."""
+    gained = claimed - owned_partitions
+    lost = owned_partitions - claimed
+    owned_partitions.clear()
+    owned_partitions.update(claimed)
+
+    if gained or lost:
+        logger.info(
+            f"{WORKER_ID} gained {len(gained)} and lost {len(lost)} partitions, it polls {len(claimed)} of {PARTITIONS}."
+        )
+    return gained, lost
+
+
+def get_partition_statistics():
+    return {
+        "partitioned": PARTITIONED,
+        "worker_id": WORKER_ID,
+        "owned": sorted(owned_partitions) if PARTITIONED else list(range(PARTITIONS)),
+    }
@@ -1,26 +1,55 @@
 import aiohttp
+import asyncio
 import collections
 import logging
 from datetime import datetime, time, timedelta, UTC
 from discord.ext import tasks
+from peewee import chunked
+from time import monotonic
 
 from actions.esi import handle_auth_error, handle_structure_error, handle_notification_error
-from actions.notification import send_notification_message
-from actions.structure import send_structure_message
-from messaging import send_background_message
-from models import Character, User, Notification
+from actions.esi import backoff_end, is_backed_off, record_character_failure, record_character_success
+from actions.esi import NOTIFICATIONS, STRUCTURES, record_structure_access
+from actions.notification import send_notification_messages, latest_attack_time, notification_index
+from actions.notification import NOTIFICATION_RETENTION
+from actions.structure import send_structure_messages, has_reinforced_structure
+from actions.structure import store_structure_snapshot, confirm_structure_snapshot, remove_structure_snapshot
+from actions.timer import update_structure_timers, fire_due_timers, load_timers
+from authentication import authenticate_character
+from concurrency import corporation_lock, notification_slots, structure_slots
+from database import run_db
+from esi_client import get_op_conditional, mark_processed
+from messaging import send_background_message, Priority
+from models import Character, User, Notification, Outbox, db
+from partitions import HEARTBEAT_INTERVAL, PARTITIONED, WORKER_ID, claim_partitions, owns, update_owned_partitions
+from scheduler import notification_schedule, structure_schedule, plan_next_notifications, plan_next_structures
+from scheduler import mark_hot, set_reinforced, structures_changed, load_characters, load_schedules
 
 logger = logging.getLogger('discord.timer.relay')
 
 # Scheduling
-NOTIFICATION_CACHE_TIME = 600
-NOTIFICATION_PHASES = 12
+SCHEDULER_TICK = 1
 
-STATUS_CACHE_TIME = 3600
-STATUS_PHASES = 12
+OUTBOX_INTERVAL = 2
+OUTBOX_BATCH = 200
+OUTBOX_RETRY_TIME = 30
+OUTBOX_MAX_RETRY_TIME = 60 * 60
+OUTBOX_MAX_ATTEMPTS = 30
 
-notification_phase = -1
-status_phase = -1
+# Seconds an outbox entry stays claimed by the replica sending it, entries of a replica which died are sent again after.
+# Claims of entries which are still queued in this replica are renewed every third of this time
+OUTBOX_CLAIM_TIME = 10 * 60
+
+# No further outbox entries are claimed while this many of them are being delivered by this replica
+OUTBOX_MAX_IN_FLIGHT = 1000
+
+outbox_in_flight = {}
+outbox_renewed_at = monotonic()
+outbox_results = []
+poll_tasks = set()
+
+# Index of the character of each corporation to fetch structures with next
+corporation_rotation = collections.defaultdict(int)
 
 
 def is_server_downtime_now(extended=False):
@@ -30,144 +59,448 @@ def is_server_downtime_now(extended=False):
     return time(11, 0) <= now_utc < time(11, 10)
 
 
-async def schedule_characters(action_lock, phase, total_phases):
-    """Returns a subset of characters depending on the current phase, such that in total_phases
-    all characters are used exactly once, and characters in the same corp are spread as evenly as possible."""
+def server_downtime_end() -> float:
+    """Returns the unix timestamp at which ESI is expected to be back after today's downtime."""
+    return datetime.now(UTC).replace(hour=11, minute=10, second=0, microsecond=0).timestamp()
 
-    try:
-        if is_server_downtime_now():
-            logger.info("ESI is probably down (11:00–11:10 UTC). Skipping this run.")
-            return
 
-        async with action_lock:
-            corporation_characters = collections.defaultdict(list)
-            for character in Character.select():
-                corporation_characters[character.corporation_id].append(character)
-
-            # Now go through each corporation and run depending on the phase
-            for corporation_id, characters in corporation_characters.items():
-                for i, character in enumerate(characters):
-                    if phase == int(i / len(characters) * total_phases):
-                        logger.debug(f"Scheduling Corporation: {corporation_id} Character: {character}.")
-                        yield character
-    except Exception as e:
-        logger.critical(f"schedule_characters got an unhandled exception: {e}.", exc_info=True)
+def start_poll(coroutine, slots: asyncio.Semaphore):
+    """Run a poll in the background, limited by the concurrency of its kind of poll."""
+
+    async def run():
+        async with slots:
+            await coroutine
+
+    task = asyncio.create_task(run())
+    poll_tasks.add(task)
+    task.add_done_callback(poll_tasks.discard)
+
+
+def dispatch_due(schedule, job, slots: asyncio.Semaphore):
+    """Start a poll for every key of a schedule which is due, or postpone them during server downtime."""
+    due_keys = schedule.pop_due()
+    if not due_keys:
+        return
+
+    if is_server_downtime_now():
+        logger.info(f"ESI is probably down (11:00–11:10 UTC). Postponing {len(due_keys)} {schedule.name} polls.")
+        schedule.postpone(due_keys, server_downtime_end())
         return
 
+    for key in due_keys:
+        start_poll(job(key), slots)
 
-@tasks.loop(seconds=NOTIFICATION_CACHE_TIME // NOTIFICATION_PHASES + 1)
-async def notification_pings(action_lock, preston, bot):
-    """Periodically fetch notifications from ESI"""
-    global notification_phase
-    notification_phase = (notification_phase + 1) % NOTIFICATION_PHASES
-    logger.debug(f"Running notification_pings in phase {notification_phase}.")
 
-    async for character in schedule_characters(action_lock, notification_phase, NOTIFICATION_PHASES):
+async def poll_notifications(character, preston):
+    """Fetch notifications of one character from ESI and relay them in order.
+    Returns the time at which ESI provides new data, if known."""
+    try:
         try:
-            try:
-                authed_preston = await preston.authenticate_from_token(character.token)
-            except aiohttp.ClientResponseError as exp:
-                await handle_auth_error(character, bot, character.user, preston, exp)
-                continue
-            try:
-                response = await authed_preston.get_op(
-                    "get_characters_character_id_notifications",
-                    character_id=character.character_id,
-                )
-            except aiohttp.ClientResponseError as exp:
-                await handle_notification_error(character, exp)
-                continue
-        except aiohttp.ClientConnectionError as exp:
-            if not is_server_downtime_now(extended=True):
-                logger.warning(
-                    f"notification_pings information gathering got a ClientConnectionError"
-                    f" for {character}, skipping..."
-                )
+            authed_preston = await authenticate_character(preston, character)
+        except aiohttp.ClientResponseError as exp:
+            await handle_auth_error(character, character.user, preston, exp)
+            await record_character_failure(character, exp, NOTIFICATIONS)
+            return
+        try:
+            response = await get_op_conditional(
+                authed_preston, character.character_id,
+                "get_characters_character_id_notifications",
+                character_id=character.character_id,
+            )
+        except aiohttp.ClientResponseError as exp:
+            await handle_notification_error(character, exp)
+            await record_character_failure(character, exp, NOTIFICATIONS)
+            return None
+        await record_character_success(character, NOTIFICATIONS)
+    except aiohttp.ClientConnectionError as exp:
+        if not is_server_downtime_now(extended=True):
+            logger.warning(
+                f"notification_pings information gathering got a ClientConnectionError"
+                f" for {character}, skipping..."
+            )
+    except Exception as e:
+        logger.error(
+            f"notification_pings information gathering got an unfamiliar exception for {character}: {e}.",
+            exc_info=True
+        )
+    else:
+        if not response.modified:
+            logger.debug(f"notification_pings got no new notifications for {character}.")
+            return response.expires
+        try:
+            await send_notification_messages(
+                list(reversed(response.data)), character.user, authed_preston,
+                identifier=str(character), requester=str(character.character_id)
+            )
+            mark_processed(response)
+
+            if (attack_time := latest_attack_time(response.data)) is not None:
+                mark_hot(character.corporation_id, attack_time.timestamp())
         except Exception as e:
             logger.error(
-                f"notification_pings information gathering got an unfamiliar exception for {character}: {e}.",
-                exc_info=True
+                f"notification_pings information sending got an unfamiliar exception for {character}: {e}.",
+                exc_info=True)
+        return response.expires
+
+
+def structure_subscribers(characters) -> list[User]:
+    """Returns the users which may see the structures of a corporation, those with a character which fetched them
+    or which did not try yet. Untried characters are polled first, so that users without access are dropped soon."""
+    return list({
+        character.user.user_id: character.user
+        for character in characters if character.structure_access is not False
+    }.values())
+
+
+async def poll_structures(character, preston, corporation_characters):
+    """Fetch the structures of the corporation of one character from ESI and relay any changes to all users
+    with a character of the corporation which could fetch them, subscriptions of other users are removed.
+    Returns the ESI response on success, False if this character could not be used and None if ESI is unreachable."""
+    try:
+        try:
+            authed_preston = await authenticate_character(preston, character)
+        except aiohttp.ClientResponseError as exp:
+            await handle_auth_error(character, character.user, preston, exp)
+            await record_character_failure(character, exp, STRUCTURES)
+            return False
+        try:
+            response = await get_op_conditional(
+                authed_preston, character.character_id,
+                "get_corporations_corporation_id_structures",
+                corporation_id=character.corporation_id,
             )
-        else:
-            try:
-                for notification in reversed(response):
-                    await send_notification_message(
-                        notification, bot, character.user, authed_preston, identifier=str(character)
-                    )
-            except Exception as e:
-                logger.error(
-                    f"notification_pings information sending got an unfamiliar exception for {character}: {e}.",
-                    exc_info=True)
-
-
-@tasks.loop(seconds=STATUS_CACHE_TIME // STATUS_PHASES + 1)
-async def status_pings(action_lock, preston, bot):
-    """Periodically fetch structure state apu from ESI"""
-    global status_phase
-    status_phase = (status_phase + 1) % STATUS_PHASES
-    logger.debug(f"Running status_pings in phase {status_phase}.")
-
-    async for character in schedule_characters(action_lock, status_phase, STATUS_PHASES):
+        except aiohttp.ClientResponseError as exp:
+            corporation_id = character.corporation_id
+            await handle_structure_error(character, authed_preston, exp, user=character.user)
+            # A character which moved to another corporation is not at fault
+            if character.corporation_id == corporation_id:
+                await record_character_failure(character, exp, STRUCTURES)
+            return False
+        await record_character_success(character, STRUCTURES)
+        await record_structure_access(character, True)
+    except aiohttp.ClientConnectionError as exp:
+        if not is_server_downtime_now(extended=True):
+            logger.warning(
+                f"status_pings information gathering got a ClientConnectionError"
+                f" for {character}, skipping..."
+            )
+        return None
+    except Exception as e:
+        logger.error(
+            f"status_pings information gathering got an unfamiliar exception for {character}: {e}.", exc_info=True
+        )
+        return False
+    else:
+        if not response.modified:
+            logger.debug(f"status_pings got unchanged structures for {character}.")
+            await run_db(confirm_structure_snapshot, character.corporation_id)
+            return response
         try:
-            try:
-                authed_preston = await preston.authenticate_from_token(character.token)
-            except aiohttp.ClientResponseError as exp:
-                await handle_auth_error(character, bot, character.user, preston, exp)
-                continue
-            try:
-                response = await authed_preston.get_op(
-                    "get_corporations_corporation_id_structures",
-                    corporation_id=character.corporation_id,
+            async with corporation_lock(character.corporation_id):
+                await send_structure_messages(
+                    response.data, structure_subscribers(corporation_characters), identifier=str(character)
                 )
-            except aiohttp.ClientResponseError as exp:
-                await handle_structure_error(character, authed_preston, exp, bot=bot, user=character.user)
+                await update_structure_timers(response.data)
+                await run_db(store_structure_snapshot, character.corporation_id, response.data)
+            mark_processed(response)
+
+            structures_changed(character.corporation_id)
+            set_reinforced(character.corporation_id, has_reinforced_structure(response.data))
+        except Exception as e:
+            logger.error(f"status_pings information sendinggot an unfamiliar exception for {character}: {e}.",
+                         exc_info=True)
+        return response
+
+
+async def poll_corporation_structures(corporation_id, characters, preston):
+    """Fetch the structures of a corporation once, rotating through its characters
+    and moving on to the next character if one of them fails. Changes are relayed to every user with a character
+    in the corporation which could fetch them or did not try yet. Characters which did not try yet go first, so that
+    users without access are dropped soon, and characters which are backing off after repeated failures are skipped.
+    Returns the time at which ESI provides new data, if known."""
+    corporation_characters = characters
+    characters = [character for character in characters if not is_backed_off(character, STRUCTURES)]
+    if not characters:
+        logger.debug(f"status_pings skips corporation {corporation_id}, all of its characters are backing off.")
+        return None
+
+    start = corporation_rotation[corporation_id]
+    rotation = [(start + offset) % len(characters) for offset in range(len(characters))]
+    rotation.sort(key=lambda index: characters[index].structure_access is not None)
+    for index in rotation:
+        result = await poll_structures(characters[index], preston, corporation_characters)
+        if result is None:
+            break
+        if result:
+            corporation_rotation[corporation_id] = index + 1
+            return result.expires
+
+    logger.debug(f"status_pings could not fetch structures of corporation {corporation_id} this cycle.")
+    corporation_rotation[corporation_id] = start + 1
+    return None
+
+
+def load_character(character_id) -> Character | None:
+    return Character.select(Character, User).join(User).where(Character.character_id == character_id).first()
+
+
+def load_user_characters(user) -> list[Character]:
+    return list(Character.select(Character, User).join(User).where(Character.user == user))
+
+
+def load_corporation_characters(corporation_id) -> list[Character]:
+    return list(
+        Character.select(Character, User).join(User)
+        .where(Character.corporation_id == corporation_id)
+        .order_by(Character.character_id)
+    )
+
+
+async def notification_job(character_id, preston):
+    """Poll notifications of one character and plan its next poll."""
+    expires = None
+    corporation_id = None
+    backoff_until = None
+    try:
+        character = await run_db(load_character, character_id)
+        if character is None:
+            logger.debug(f"notification_job() dropping revoked character {character_id}.")
+            notification_schedule.remove(character_id)
+            return
+        if not owns(character.corporation_id):
+            logger.debug(f"notification_job() dropping character {character_id} polled by another replica.")
+            notification_schedule.remove(character_id)
+            return
+        corporation_id = character.corporation_id
+        if not is_backed_off(character, NOTIFICATIONS):
+            expires = await poll_notifications(character, preston)
+        backoff_until = backoff_end(character, NOTIFICATIONS)
+    except Exception as e:
+        logger.error(f"notification_job() unhandled exception for {character_id}: {e}", exc_info=True)
+    plan_next_notifications(character_id, corporation_id, expires, not_before=backoff_until)
+
+
+async def structure_job(corporation_id, preston):
+    """Poll structures of one corporation and plan its next poll."""
+    expires = None
+    characters = []
+    not_before = None
+    try:
+        if not owns(corporation_id):
+            logger.debug(f"structure_job() dropping corporation {corporation_id} polled by another replica.")
+            structure_schedule.remove(corporation_id)
+            return
+        characters = await run_db(load_corporation_characters, corporation_id)
+        if not characters:
+            logger.debug(f"structure_job() dropping corporation {corporation_id} without characters.")
+            structure_schedule.remove(corporation_id)
+            async with corporation_lock(corporation_id):
+                await run_db(remove_structure_snapshot, corporation_id)
+            return
+        expires = await poll_corporation_structures(corporation_id, characters, preston)
+        if all(is_backed_off(character, STRUCTURES) for character in characters):
+            not_before = min(backoff_end(character, STRUCTURES) for character in characters)
+    except Exception as e:
+        logger.error(f"structure_job() unhandled exception for {corporation_id}: {e}", exc_info=True)
+    plan_next_structures(corporation_id, len(characters), expires, not_before=not_before)
+
+
+@tasks.loop(seconds=SCHEDULER_TICK)
+async def notification_pings(preston):
+    """Fetch notifications from ESI for every character whose cached notifications expired"""
+    try:
+        dispatch_due(notification_schedule, lambda key: notification_job(key, preston), notification_slots)
+    except Exception as e:
+        logger.critical(f"notification_pings got an unhandled exception: {e}.", exc_info=True)
+
+
+@tasks.loop(seconds=SCHEDULER_TICK)
+async def status_pings(preston):
+    """Fetch structure state from ESI for every corporation whose cached structures expired"""
+    try:
+        dispatch_due(structure_schedule, lambda key: structure_job(key, preston), structure_slots)
+    except Exception as e:
+        logger.critical(f"status_pings got an unhandled exception: {e}.", exc_info=True)
+
+
+@tasks.loop(seconds=SCHEDULER_TICK)
+async def timer_pings():
+    """Send fuel and reinforcement reminders at the exact time they are due"""
+    try:
+        await fire_due_timers()
+    except Exception as e:
+        logger.critical(f"timer_pings got an unhandled exception: {e}.", exc_info=True)
+
+
+async def deliver_outbox_entry(bot, entry):
+    """Send one outbox entry and remember the result for the next outbox run."""
+    try:
+        success = await send_background_message(
+            bot, entry.user, entry.message, entry.identifier, priority=Priority(entry.priority)
+        )
+    except Exception as e:
+        logger.error(f"deliver_outbox_entry() unhandled exception for {entry}: {e}", exc_info=True)
+        success = False
+    outbox_results.append((entry, success))
+
+
+def store_outbox_results(results):
+    """Remove delivered outbox entries and reschedule failed ones with exponential backoff."""
+    now = datetime.now(UTC)
+    with db.atomic():
+        delivered = [entry.id for entry, success in results if success]
+        if delivered:
+            Outbox.delete().where(Outbox.id.in_(delivered)).execute()
+
+        for entry, success in results:
+            if success:
                 continue
-        except aiohttp.ClientConnectionError as exp:
-            if not is_server_downtime_now(extended=True):
-                logger.warning(
-                    f"status_pings information gathering got a ClientConnectionError"
-                    f" for {character}, skipping..."
-                )
+            attempts = entry.attempts + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.warning(f"Giving up on {entry} after {attempts} attempts.")
+                Outbox.delete().where(Outbox.id == entry.id).execute()
+            else:
+                retry_time = min(OUTBOX_RETRY_TIME * 2 ** entry.attempts, OUTBOX_MAX_RETRY_TIME)
+                Outbox.update(
+                    attempts=attempts,
+                    next_attempt_at=now + timedelta(seconds=retry_time),
+                    claimed_by=None,
+                    claimed_until=None,
+                ).where(Outbox.id == entry.id).execute()
+
+
+def claim_due_outbox_entries(limit: int) -> list[Outbox]:
+    """Claim due outbox entries for this replica and returns them.
+    The claim is a conditional update, so replicas sharing the database never send the same entry twice."""
+    now = datetime.now(UTC)
+    is_unclaimed = Outbox.claimed_until.is_null() | (Outbox.claimed_until < now)
+    due = Outbox.select(Outbox.id).where((Outbox.next_attempt_at <= now) & is_unclaimed).order_by(
+        Outbox.priority, Outbox.id
+    ).limit(limit)
+    due_ids = [entry.id for entry in due]
+    if not due_ids:
+        return []
+
+    Outbox.update(claimed_by=WORKER_ID, claimed_until=now + timedelta(seconds=OUTBOX_CLAIM_TIME)).where(
+        Outbox.id.in_(due_ids) & is_unclaimed
+    ).execute()
+    return list(
+        Outbox
+        .select(Outbox, User)
+        .join(User)
+        .where(Outbox.id.in_(due_ids) & (Outbox.claimed_by == WORKER_ID))
+        .order_by(Outbox.priority, Outbox.id)
+    )
+
+
+def renew_outbox_claims(entry_ids):
+    """Extend the claims of outbox entries which are still queued in this replica, e.g. behind a rate limit."""
+    claimed_until = datetime.now(UTC) + timedelta(seconds=OUTBOX_CLAIM_TIME)
+    with db.atomic():
+        for batch in chunked(entry_ids, 100):
+            Outbox.update(claimed_until=claimed_until).where(
+                Outbox.id.in_(batch) & (Outbox.claimed_by == WORKER_ID)
+            ).execute()
+
+
+async def record_outbox_results():
+    """Store the results of finished deliveries."""
+    results = list(outbox_results)
+    outbox_results.clear()
+    if not results:
+        return
+
+    try:
+        await run_db(store_outbox_results, results)
+    except Exception:
+        # Keep the results for the next run, the entries stay claimed by this replica until then
+        outbox_results.extend(results)
+        raise
+    finally:
+        for entry, _ in results:
+            outbox_in_flight.pop(entry.id, None)
+
+
+@tasks.loop(seconds=OUTBOX_INTERVAL)
+async def outbox_pings(bot):
+    """Periodically send due messages from the outbox without waiting for their delivery.
+    Claims of entries which are still being delivered are renewed, so that no other replica sends them again,
+    and no new entries are claimed while too many are being delivered."""
+    global outbox_renewed_at
+    try:
+        await record_outbox_results()
+
+        if outbox_in_flight and monotonic() - outbox_renewed_at > OUTBOX_CLAIM_TIME / 3:
+            await run_db(renew_outbox_claims, list(outbox_in_flight))
+            outbox_renewed_at = monotonic()
+
+        limit = min(OUTBOX_BATCH, OUTBOX_MAX_IN_FLIGHT - len(outbox_in_flight))
+        if limit <= 0:
+            logger.debug(f"outbox_pings() delivers {len(outbox_in_flight)} entries, claiming no more for now.")
+            return
+
+        due_entries = await run_db(claim_due_outbox_entries, limit)
+        for entry in due_entries:
+            if entry.id in outbox_in_flight:
+                continue
+            outbox_in_flight[entry.id] = asyncio.create_task(deliver_outbox_entry(bot, entry))
+    except Exception as e:
+        logger.error(f"outbox_pings() unhandled exception: {e}", exc_info=True)
+
+
+@tasks.loop(seconds=HEARTBEAT_INTERVAL)
+async def partition_pings():
+    """Renew the partition leases of this replica and start polling the corporations of partitions it took over,
+    as well as characters which were added through the gateway in another process.
+    Only characters changed since the last heartbeat are loaded, unless partitions were taken over.
+    Polls and timers of partitions it lost are dropped once they are due."""
+    gained = set()
+    if PARTITIONED:
+        try:
+            gained, _ = update_owned_partitions(await run_db(claim_partitions))
         except Exception as e:
-            logger.error(
-                f"status_pings information gathering got an unfamiliar exception for {character}: {e}.", exc_info=True
-            )
-        else:
-            try:
-                for structure in response:
-                    await send_structure_message(structure, bot, character.user, identifier=str(character))
-            except Exception as e:
-                logger.error(f"status_pings information sendinggot an unfamiliar exception for {character}: {e}.",
-                             exc_info=True)
+            # The leases run out without renewal, so stop polling before another replica takes over
+            update_owned_partitions(set())
+            logger.error(f"partition_pings() could not renew leases: {e}", exc_info=True)
+            return
+
+    try:
+        load_schedules(await run_db(load_characters, not gained))
+        if gained:
+            await load_timers(gained)
+    except Exception as e:
+        logger.error(f"partition_pings() unhandled exception: {e}", exc_info=True)
+
+
+def load_users_without_characters() -> list[User]:
+    return [user for user in User.select() if not user.characters.exists()]
 
 
 @tasks.loop(hours=42)
-async def no_auth_pings(action_lock, bot):
+async def no_auth_pings(bot):
     """Periodically remind users that don't have characters linked so they don't get surprised."""
-    async with action_lock:
-        try:
-            for user in User.select():
-                if not user.characters.exists():
-                    warning_text = (
-                        "### WARNING\n"
-                        f"<@{user.user_id}>, your discord account is linked to timer-bot, but you have not authorized any characters.\n"
-                        f"This means you will not get any notifications about reinforced structures or fuel"
-                        f"- If you to not intend to use this bot anymore, write `/revoke` to de-register.\n"
-                        f"- Otherwise add some character with `/auth`"
-                    )
-                    await send_background_message(bot, user, warning_text)
+    try:
+        for user in await run_db(load_users_without_characters):
+            warning_text = (
+                "### WARNING\n"
+                f"<@{user.user_id}>, your discord account is linked to timer-bot, but you have not authorized any characters.\n"
+                f"This means you will not get any notifications about reinforced structures or fuel"
+                f"- If you to not intend to use this bot anymore, write `/revoke` to de-register.\n"
+                f"- Otherwise add some character with `/auth`"
+            )
+            await send_background_message(bot, user, warning_text)
 
-        except Exception as e:
-            logger.error(f"Error while trying to notify users without auth: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"Error while trying to notify users without auth: {e}", exc_info=True)
 
 
 @tasks.loop(hours=1)
-async def cleanup_old_notifications(action_lock):
+async def cleanup_old_notifications():
     """Delete notifications older than 4 weeks."""
-    async with action_lock:
-        try:
-            threshold = datetime.now(UTC) - timedelta(days=2)
-            deleted = Notification.delete().where(Notification.timestamp < threshold).execute()
-            logger.debug(f"cleanup_old_notifications() deleted {deleted} old notifications older than 2 days.")
-        except Exception as e:
-            logger.error(f"cleanup_old_notifications() unhandled exception: {e}", exc_info=True)
+    try:
+        threshold = datetime.now(UTC) - NOTIFICATION_RETENTION
+        deleted = await run_db(Notification.delete().where(Notification.timestamp < threshold).execute)
+        notification_index.prune()
+        logger.debug(f"cleanup_old_notifications() deleted {deleted} old notifications older than 2 days.")
+    except Exception as e:
+        logger.error(f"cleanup_old_notifications() unhandled exception: {e}", exc_info=True)
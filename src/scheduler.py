@@ -0,0 +1,250 @@
+import heapq
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta, UTC
+from itertools import count
+
+from models import Character
+from partitions import owns
+
+# Configure the logger
+logger = logging.getLogger('discord.timer.scheduler')
+
+# Seconds after the ESI cache expired until a poll runs, randomized to keep the load flat
+POLL_JITTER = 30
+
+# Never poll the same key more often than this, even if ESI says the data already expired
+MIN_POLL_INTERVAL = 30
+
+# Corporations with recent attacks or reinforced structures are polled faster for this many seconds
+HOT_WINDOW = int(os.getenv("HOT_WINDOW", str(2 * 60 * 60)))
+HOT_POLL_JITTER = 2
+HOT_STATUS_INTERVAL = int(os.getenv("HOT_STATUS_INTERVAL", "300"))
+
+# Corporations without structure changes for this many seconds poll their structures QUIET_BACKOFF times slower
+QUIET_AFTER = int(os.getenv("QUIET_AFTER", str(3 * 24 * 60 * 60)))
+QUIET_BACKOFF = float(os.getenv("QUIET_BACKOFF", "2"))
+
+# Characters changed this many seconds before the last pickup are loaded again, which covers clock differences
+# between replicas and transactions which committed after the pickup
+PICKUP_OVERLAP = 60
+
+
+class PollScheduler:
+    """Plans when each key (a character or a corporation) is polled next, using a heap ordered by due time.
+    Stale heap entries are skipped instead of removed, the latest plan for each key is kept in planned.
+    Keys which are being polled right now are kept in running until their next poll is planned or they are removed."""
+
+    def __init__(self, name: str, interval: int):
+        self.name = name
+        self.interval = interval
+        self.heap = []
+        self.planned = {}
+        self.running = set()
+        self.sequence = count()
+        self.polls = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def plan(self, key, due: float):
+        """Plan the next poll of a key at a unix timestamp, replacing any earlier plan."""
+        self.running.discard(key)
+        self.planned[key] = due
+        heapq.heappush(self.heap, (due, next(self.sequence), key))
+
+    def add(self, key, immediately: bool = False):
+        """Start polling a key, either right away or at a random point within one interval.
+        Keys which are being polled right now are left alone, their poll plans the next one when it is done."""
+        if key in self.running:
+            return
+        if key in self.planned:
+            if immediately:
+                self.plan(key, time.time())
+            return
+        self.plan(key, time.time() + (0 if immediately else random.uniform(0, self.interval)))
+
+    def remove(self, key):
+        """Stop polling a key, its heap entries are skipped from now on."""
+        self.planned.pop(key, None)
+        self.running.discard(key)
+
+    def pop_due(self, now: float | None = None) -> list:
+        """Returns all keys which are due, they are running and not planned again until plan_next is called."""
+        now = time.time() if now is None else now
+        due_keys = []
+        while self.heap and self.heap[0][0] <= now:
+            due, _, key = heapq.heappop(self.heap)
+            if self.planned.get(key) != due:
+                continue
+            del self.planned[key]
+            self.running.add(key)
+            due_keys.append(key)
+
+            lag = now - due
+            self.polls += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+        return due_keys
+
+    def plan_next(self, key, expires=None, jitter: float = POLL_JITTER, delay: float = 0, not_before=None):
+        """Plan the next poll of a key shortly after its ESI data expires, or one interval later if unknown.
+        A delay is added on top, e.g. to back off keys which rarely change, and the poll is never planned
+        before not_before, e.g. while a character is backing off after repeated failures."""
+        now = time.time()
+        if expires is None:
+            due = now + self.interval
+        else:
+            due = max(expires.timestamp(), now + MIN_POLL_INTERVAL - jitter)
+        if not_before is not None:
+            due = max(due, not_before.timestamp())
+        self.plan(key, due + delay + random.uniform(0, jitter))
+
+    def advance(self, key, due: float):
+        """Move the next poll of a key forward to due if it is planned later, keys being polled right now are left."""
+        if key in self.planned and self.planned[key] > due:
+            self.plan(key, due)
+
+    def postpone(self, keys, until: float):
+        """Spread keys over one interval starting at until, e.g. after server downtime."""
+        for key in keys:
+            self.plan(key, until + random.uniform(0, self.interval))
+
+    def statistics(self) -> dict:
+        return {
+            "planned": len(self.planned),
+            "running": len(self.running),
+            "polls": self.polls,
+            "average_lag": self.total_lag / self.polls if self.polls else 0.0,
+            "max_lag": self.max_lag,
+        }
+
+
+NOTIFICATION_CACHE_TIME = 600
+STATUS_CACHE_TIME = 3600
+
+notification_schedule = PollScheduler("notifications", NOTIFICATION_CACHE_TIME)
+structure_schedule = PollScheduler("structures", STATUS_CACHE_TIME)
+
+hot_until = {}
+reinforced_corporations = set()
+structures_changed_at = {}
+characters_loaded_at = None
+
+
+def mark_hot(corporation_id, since: float | None = None):
+    """Poll a corporation in the hot tier for HOT_WINDOW seconds after since, e.g. the time of an attack."""
+    corporation_id = str(corporation_id)
+    until = (time.time() if since is None else since) + HOT_WINDOW
+    if until <= max(time.time(), hot_until.get(corporation_id, 0)):
+        return
+
+    if not is_hot(corporation_id):
+        logger.info(f"Corporation {corporation_id} moved to the hot tier.")
+        structure_schedule.advance(corporation_id, time.time())
+    hot_until[corporation_id] = until
+
+
+def set_reinforced(corporation_id, reinforced: bool):
+    """Keep a corporation in the hot tier while it has reinforced structures."""
+    corporation_id = str(corporation_id)
+    if reinforced:
+        reinforced_corporations.add(corporation_id)
+    else:
+        reinforced_corporations.discard(corporation_id)
+
+
+def structures_changed(corporation_id):
+    """Remember that the structures of a corporation changed, which stops it from backing off."""
+    structures_changed_at[str(corporation_id)] = time.time()
+
+
+def is_hot(corporation_id) -> bool:
+    corporation_id = str(corporation_id)
+    return corporation_id in reinforced_corporations or hot_until.get(corporation_id, 0) > time.time()
+
+
+def is_quiet(corporation_id) -> bool:
+    corporation_id = str(corporation_id)
+    return not is_hot(corporation_id) and time.time() - structures_changed_at.setdefault(
+        corporation_id, time.time()
+    ) > QUIET_AFTER
+
+
+def plan_next_notifications(character_id, corporation_id, expires=None, not_before=None):
+    """Plan the next notification poll of a character, right when ESI expires for hot corporations."""
+    jitter = HOT_POLL_JITTER if is_hot(corporation_id) else POLL_JITTER
+    notification_schedule.plan_next(str(character_id), expires, jitter=jitter, not_before=not_before)
+
+
+def plan_next_structures(corporation_id, character_count: int, expires=None, not_before=None):
+    """Plan the next structure poll of a corporation depending on its tier.
+    Hot corporations rotate to their next character, which has its own ESI cache, instead of waiting for expiry.
+    Corporations whose characters are all backing off are not polled before not_before."""
+    corporation_id = str(corporation_id)
+    if not_before is not None:
+        structure_schedule.plan_next(corporation_id, expires, not_before=not_before)
+    elif is_hot(corporation_id):
+        interval = max(HOT_STATUS_INTERVAL, STATUS_CACHE_TIME / max(1, character_count))
+        due = time.time() + interval
+        if expires is not None and character_count == 1:
+            due = max(due, expires.timestamp())
+        structure_schedule.plan(corporation_id, due + random.uniform(0, HOT_POLL_JITTER))
+    elif is_quiet(corporation_id):
+        structure_schedule.plan_next(corporation_id, expires, delay=STATUS_CACHE_TIME * (QUIET_BACKOFF - 1))
+    else:
+        structure_schedule.plan_next(corporation_id, expires)
+
+
+def load_characters(changed_only: bool = False) -> list[Character]:
+    """Returns all characters, or only those added or changed since the last call.
+    Characters returned twice are harmless, load_schedules keeps the plans of keys it knows already."""
+    global characters_loaded_at
+    loaded_at = datetime.now(UTC)
+    query = Character.select(Character.character_id, Character.corporation_id)
+    if changed_only and characters_loaded_at is not None:
+        query = query.where(Character.updated_at >= characters_loaded_at - timedelta(seconds=PICKUP_OVERLAP))
+    characters = list(query)
+    characters_loaded_at = loaded_at
+    return characters
+
+
+def load_schedules(characters: list[Character]):
+    """Plan polls for every character and corporation of this replica, spread evenly over one interval.
+    Keys which are planned already keep their plan, so this also picks up characters added on other replicas."""
+    planned = len(notification_schedule.planned), len(structure_schedule.planned)
+    for character in characters:
+        if owns(character.corporation_id):
+            notification_schedule.add(str(character.character_id))
+            structure_schedule.add(str(character.corporation_id))
+
+    if planned != (len(notification_schedule.planned), len(structure_schedule.planned)):
+        logger.info(
+            f"load_schedules() planned {len(notification_schedule.planned)} characters "
+            f"and {len(structure_schedule.planned)} corporations."
+        )
+
+
+def character_added(character):
+    """Start polling a newly authorized character and its corporation right away.
+    Characters of corporations polled by another replica are picked up by it with its next load_schedules."""
+    if not owns(character.corporation_id):
+        return
+    notification_schedule.add(str(character.character_id), immediately=True)
+    structure_schedule.add(str(character.corporation_id), immediately=True)
+
+
+def character_removed(character):
+    """Stop polling a revoked character, its corporation is dropped once it has no characters left."""
+    notification_schedule.remove(str(character.character_id))
+
+
+def get_scheduler_statistics():
+    return {
+        notification_schedule.name: notification_schedule.statistics(),
+        structure_schedule.name: structure_schedule.statistics(),
+        "hot_corporations": sum(
+            1 for corporation_id in set(hot_until) | reinforced_corporations if is_hot(corporation_id)
+        ),
+    }
@@ -1,76 +1,139 @@
 import logging
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, UTC
 import os
 
-import dateutil.parser
 from aiohttp import web
 from discord.ext import tasks
 from preston import Preston
 
-from models import User, Character, Challenge, Notification, db, Structure
-from actions.notification import is_structure_notification
-from messaging import user_disconnected_count
+from models import User, Character, Challenge, Structure
+from actions.notification import skip_notifications, get_notification_statistics
+from actions.structure import remove_structure_subscriptions
+from authentication import character_from_token, forget_character
+from database import run_db, get_database_statistics
+from esi_client import esi_call, get_esi_statistics
+from messaging import get_delivery_statistics
+from names import get_name_statistics
+from partitions import get_partition_statistics
+from scheduler import character_added, get_scheduler_statistics
 
 # Configure the logger
 logger = logging.getLogger('discord.timer.callback')
 
 
+def store_character(user_id, character_id, corporation_id, token) -> tuple[Character, bool] | None:
+    """Create or update an authorized character, returns None if its user does not exist."""
+    user = User.get_or_none(user_id=user_id)
+    if not user:
+        return None
+
+    character, created = Character.get_or_create(
+        character_id=character_id, user=user,
+        defaults={"token": token, "corporation_id": corporation_id}
+    )
+    old_corporation, had_access = character.corporation_id, character.structure_access
+    moved = str(old_corporation) != str(corporation_id)
+    if moved:
+        character.structure_access = None
+    character.corporation_id = corporation_id
+    character.token = token
+    character.failure_count = 0
+    character.backoff_until = None
+    character.structure_failure_count = 0
+    character.structure_backoff_until = None
+    character.disconnected_count = 0
+    character.disconnected_since = None
+    character.updated_at = datetime.now(UTC)
+    character.save()
+    if moved and had_access is not False:
+        remove_structure_subscriptions(old_corporation, user.user_id)
+    return character, created
+
+
+async def health(request):
+    """Health check endpoint that verifies database connectivity."""
+    health_status = {
+        "status": "healthy",
+        "database": "unknown",
+        "timestamp": None
+    }
+
+    try:
+        # Try to execute a simple query to test the connection
+        structure_count = await run_db(Structure.select().count)
+
+        corporation_count = await run_db(
+            Character
+            .select(Character.corporation_id)
+            .distinct()
+            .count
+        )
+
+        health_status.update({
+            "status": "healthy",
+            "database": "connected",
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "counts": {
+                "structures": structure_count,
+                "corporations": corporation_count,
+            },
+        })
+
+        logger.debug("Health check passed")
+        return web.json_response(health_status, status=200)
+
+    except Exception as e:
+        health_status.update({
+            "status": "unhealthy",
+            "database": "disconnected",
+            "error": str(e),
+            "timestamp": datetime.utcnow().isoformat() + "Z"
+        })
+
+        logger.warning(f"Health check failed: {e}")
+        return web.json_response(health_status, status=503)
+
+
+async def metrics(request):
+    """Return internal queue and cache statistics of this process."""
+    return web.json_response({
+        "delivery": get_delivery_statistics(),
+        "database": get_database_statistics(),
+        "esi": get_esi_statistics(),
+        "names": get_name_statistics(),
+        "notifications": get_notification_statistics(),
+        "partitions": get_partition_statistics(),
+        "scheduler": get_scheduler_statistics(),
+    })
+
+
+async def start_site(routes: web.RouteTableDef, port: int):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, port=port)
+    await site.start()
+
+
+@tasks.loop(count=1)
+async def metrics_server():
+    """Serve /health and /metrics on their own port, which unlike the callback port is not meant to be public."""
+    routes = web.RouteTableDef()
+    routes.get('/health')(health)
+    routes.get('/metrics')(metrics)
+    await start_site(routes, int(os.getenv('METRICS_PORT', '9100')))
+
+
 @tasks.loop(count=1)
 async def webserver(bot, preston: Preston):
     routes = web.RouteTableDef()
+    routes.get('/health')(health)
 
     @routes.get('/')
     async def hello(request):
         return web.Response(text="Timer Bot Callback Server (https://github.com/14rynx/timer-bot)")
 
-    @routes.get('/health')
-    async def health(request):
-        """Health check endpoint that verifies database connectivity."""
-        health_status = {
-            "status": "healthy",
-            "database": "unknown",
-            "timestamp": None
-        }
-        
-        try:
-            # Test database connection with a simple query
-            if db.is_closed():
-                db.connect()
-            
-            # Try to execute a simple query to test the connection
-            structure_count = Structure.select().count()
-
-            corporation_count = (
-                Character
-                .select(Character.corporation_id)
-                .distinct()
-                .count()
-            )
-
-            health_status.update({
-                "status": "healthy",
-                "database": "connected",
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-                "counts": {
-                    "structures": structure_count,
-                    "corporations": corporation_count,
-                },
-            })
-            
-            logger.debug("Health check passed")
-            return web.json_response(health_status, status=200)
-            
-        except Exception as e:
-            health_status.update({
-                "status": "unhealthy",
-                "database": "disconnected",
-                "error": str(e),
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            })
-            
-            logger.warning(f"Health check failed: {e}")
-            return web.json_response(health_status, status=503)
-
     @routes.get('/callback/')
     async def callback(request):
         # Get the code and state from the login process
@@ -78,7 +141,7 @@ async def webserver(bot, preston: Preston):
         state = request.query.get('state')
 
         # Verify the state and get the user ID
-        challenge = Challenge.get_or_none(Challenge.state == state)
+        challenge = await run_db(Challenge.get_or_none, Challenge.state == state)
         if not challenge:
             logger.warning("Failed to verify challenge")
             return web.Response(text="Authentication failed: State mismatch", status=403)
@@ -92,57 +155,45 @@ async def webserver(bot, preston: Preston):
             return web.Response(text="Authentication failed!", status=403)
 
         # Get character data
-        character_data = await authed_preston.whoami()
+        character_data = await character_from_token(authed_preston)
         character_id = character_data.get("character_id")
         character_name = character_data.get("character_name")
 
         try:
             # Try fast affiliation API
-            corporation_id = (await preston.post_op(
+            corporation_id = (await esi_call(
+                preston.post_op,
                 'post_characters_affiliation',
                 path_data={},
                 post_data=[character_id]
             ))[0].get("corporation_id")
         except Exception as e:
             # Fall back to slow character API
-            corporation_id = (await preston.get_op(
+            corporation_id = (await esi_call(
+                preston.get_op,
                 'get_characters_character_id',
                 character_id=character_id
             )).get("corporation_id")
 
         # Create / Update user and store refresh_token
-        user = User.get_or_none(user_id=challenge.user.user_id)
-
-        if not user:
+        stored = await run_db(
+            store_character, challenge.user_id, character_id, corporation_id, authed_preston.refresh_token
+        )
+        if stored is None:
             return web.Response(text=f"Error: User does not exist!", status=400)
 
-        character, created = Character.get_or_create(
-            character_id=character_id, user=user,
-            defaults={"token": authed_preston.refresh_token, "corporation_id": corporation_id}
-        )
-        character.corporation_id = corporation_id
-        character.token = authed_preston.refresh_token
-        character.save()
+        character, created = stored
+        forget_character(character_id)
+        character_added(character)
 
         # Mark old notifications as skipped
-        notifications = await authed_preston.get_op(
+        notifications = await esi_call(
+            authed_preston.get_op,
             "get_characters_character_id_notifications",
             character_id=character_id,
         )
 
-        for notification in notifications:
-            if is_structure_notification(notification):
-                timestamp = dateutil.parser.isoparse(notification.get("timestamp"))
-
-                if timestamp < datetime.now(timezone.utc) - timedelta(days=1):
-                    continue
-
-                notification, created = Notification.get_or_create(
-                    notification_id=str(notification.get("notification_id")),
-                    timestamp=timestamp
-                )
-                notification.sent = True
-                notification.save()
+        await skip_notifications(notifications)
 
         logger.info(f"Added character {character}.")
         if created:
@@ -155,10 +206,8 @@ async def webserver(bot, preston: Preston):
         """Return list of users who currently have no valid channel."""
 
         users_data = []
-        for u, count in user_disconnected_count.items():
-            user_id = getattr(u, "user_id", None)
-            if not user_id:
-                continue
+        for u in await run_db(list, User.select().where(User.disconnected_count > 0)):
+            user_id = u.user_id
 
             discord_user = None
             try:
@@ -171,7 +220,7 @@ async def webserver(bot, preston: Preston):
                 "handle": f"{discord_user}" if discord_user else "<unknown>",
                 "name": getattr(discord_user, "name", None),
                 "discriminator": getattr(discord_user, "discriminator", None),
-                "attempts": count,
+                "attempts": u.disconnected_count,
             })
 
         return web.json_response({
@@ -179,9 +228,4 @@ async def webserver(bot, preston: Preston):
             "users": users_data
         })
 
-    app = web.Application()
-    app.add_routes(routes)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, port=int(os.getenv('CALLBACK_PORT', '80')))
-    await site.start()
+    await start_site(routes, int(os.getenv('CALLBACK_PORT', '80')))